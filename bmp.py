@@ -0,0 +1,70 @@
+import struct
+
+import numpy as np
+
+FILE_HEADER = struct.Struct('<2sIHHI')
+INFO_HEADER = struct.Struct('<IiiHHI')
+BI_RGB = 0
+# bytes per pixel of the bit depths PIL decodes to plain RGB
+BYTES_PER_PIXEL = {24: 3, 32: 4}
+
+
+class BmpCarrier():
+    """Color values of an uncompressed BMP, read and written in place through
+    a memory mapping. Values are indexed in the same order as a flattened
+    Image.getdata(): top row first, R, G, B per pixel."""
+
+    def __init__(self, path, width, height, bytes_per_pixel, pixel_offset, mode='r') -> None:
+        self.path = path
+        # negative heights are stored top-down, positive ones bottom-up
+        self.bottom_up = height > 0
+        self.size = (width, abs(height))
+        self.bytes_per_pixel = bytes_per_pixel
+        self.pixel_offset = pixel_offset
+        self.stride = (width * bytes_per_pixel + 3) // 4 * 4
+        self._map = np.memmap(path, dtype=np.uint8, mode=mode)
+
+    def __len__(self):
+        return 3 * self.size[0] * self.size[1]
+
+    def _offsets(self, key):
+        if not isinstance(key, slice):
+            raise TypeError('BmpCarrier only supports slicing')
+        start, stop, step = key.indices(len(self))
+        index = np.arange(start, stop, step)
+        pixel, channel = np.divmod(index, 3)
+        row, col = np.divmod(pixel, self.size[0])
+        if self.bottom_up:
+            row = self.size[1] - 1 - row
+        # pixels are stored as BGR(X)
+        return self.pixel_offset + row * self.stride + col * self.bytes_per_pixel + 2 - channel
+
+    def __getitem__(self, key):
+        return self._map[self._offsets(key)]
+
+    def __setitem__(self, key, values):
+        self._map[self._offsets(key)] = values
+
+    def flush(self):
+        """Writes the touched pages back to the file."""
+        self._map.flush()
+
+
+def open_bmp(path, mode='r'):
+    """Returns a BmpCarrier for path if it is a BMP we can map directly
+    (uncompressed, 24 or 32 bits per pixel), None otherwise."""
+    with open(path, 'rb') as f:
+        head = f.read(FILE_HEADER.size + INFO_HEADER.size)
+    if len(head) < FILE_HEADER.size + INFO_HEADER.size:
+        return None
+    magic, _, _, _, pixel_offset = FILE_HEADER.unpack_from(head)
+    if magic != b'BM':
+        return None
+    header_size, width, height, planes, bit_count, compression = INFO_HEADER.unpack_from(
+        head, FILE_HEADER.size
+    )
+    if header_size < 40 or planes != 1 or width <= 0 or height == 0:
+        return None
+    if compression != BI_RGB or bit_count not in BYTES_PER_PIXEL:
+        return None
+    return BmpCarrier(path, width, height, BYTES_PER_PIXEL[bit_count], pixel_offset, mode)
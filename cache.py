@@ -0,0 +1,108 @@
+import os,hashlib,threading
+
+import numpy as np
+from collections import OrderedDict
+
+# in-process budget for decoded carriers
+CACHE_BYTES = 256 * 1024 * 1024
+# modes whose pixels round trip through Image.fromarray
+CACHED_MODES = ('RGB', 'RGBA')
+# appended to a .npy file while it is written
+TMP_SUFFIX = '.tmp.npy'
+
+
+class CachedCarrier():
+    """Decoded pixels of a single-frame carrier, shape (height, width, bands)."""
+
+    def __init__(self, path, pixels) -> None:
+        self.path = path
+        self.pixels = pixels
+        self.size = (pixels.shape[1], pixels.shape[0])
+
+
+class CarrierCache():
+    """Decoded carrier pixels keyed by path, mtime and size. Entries live in
+    an in-process LRU bounded by max_bytes and, if directory is given, in
+    .npy files there that are memory mapped back on a miss."""
+
+    def __init__(self, max_bytes=CACHE_BYTES, directory=None) -> None:
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def _key(self, path):
+        st = os.stat(path)
+        return (os.path.realpath(path), st.st_mtime_ns, st.st_size)
+
+    def _npy_dir(self, key):
+        # every version of one image lives in the same directory
+        return os.path.join(self.directory, hashlib.sha256(key[0].encode('utf8')).hexdigest())
+
+    def _npy_path(self, key):
+        return os.path.join(self._npy_dir(key), f'{key[1]}-{key[2]}.npy')
+
+    def _prune(self, key):
+        """Removes the .npy files of older versions of the image, including
+        those written by other processes or already evicted from memory."""
+        keep = os.path.basename(self._npy_path(key))
+        for name in os.listdir(self._npy_dir(key)):
+            # files still being written by another put are left alone
+            if name != keep and not name.endswith(TMP_SUFFIX):
+                try:
+                    os.remove(os.path.join(self._npy_dir(key), name))
+                except FileNotFoundError:
+                    pass
+
+    def get(self, path):
+        """Returns the cached pixels of the image at path, or None."""
+        key = self._key(path)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        if self.directory is not None and os.path.exists(self._npy_path(key)):
+            pixels = np.load(self._npy_path(key), mmap_mode='r')
+            self._insert(key, pixels)
+            return pixels
+        return None
+
+    def put(self, path, pixels):
+        """Caches the pixels of the image currently stored at path, dropping
+        entries for older versions of it."""
+        key = self._key(path)
+        pixels.flags.writeable = False
+        self._insert(key, pixels)
+        if self.directory is not None:
+            npy_path = self._npy_path(key)
+            tmp_path = npy_path + TMP_SUFFIX
+            os.makedirs(os.path.dirname(npy_path), exist_ok=True)
+            np.save(tmp_path, pixels)
+            os.replace(tmp_path, npy_path)
+            self._prune(key)
+
+    def _insert(self, key, pixels):
+        with self._lock:
+            for old in [k for k in self._entries if k[0] == key[0] and k != key]:
+                self._bytes -= self._entries.pop(old).nbytes
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key).nbytes
+            if pixels.nbytes > self.max_bytes:
+                return
+            self._entries[key] = pixels
+            self._bytes += pixels.nbytes
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+# shared by every Steg that is not given its own cache
+carrier_cache = CarrierCache()
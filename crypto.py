@@ -1,18 +1,38 @@
+import hashlib,struct,threading
+
+from collections import OrderedDict, namedtuple
+from time import perf_counter
 from Crypto.Cipher import AES
 from Crypto.Hash import SHA256, HMAC
-from Crypto.Protocol.KDF import PBKDF2
 from Crypto.Random.random import getrandbits
 from Crypto.Util import Counter
 
 # see: http://www.daemonology.net/blog/2009-06-11-cryptographic-right-answers.html
 
-EXPANSION_COUNT = (10000, 10000, 100000)
+EXPANSION_COUNT = (10000, 10000, 100000, 100000)
 AES_KEY_LEN = 256
-SALT_LEN = (128, 256, 256)
+SALT_LEN = (128, 256, 256, 256)
 HASH = SHA256
+HASH_NAME = 'sha256'   # name of HASH for hashlib
 PREFIX = b'sc'
-HEADER = (PREFIX + b'\x00\x00', PREFIX + b'\x00\x01', PREFIX + b'\x00\x02')
-LATEST = 2   # index into SALT_LEN, EXPANSION_COUNT, HEADER
+HEADER = (PREFIX + b'\x00\x00', PREFIX + b'\x00\x01', PREFIX + b'\x00\x02', PREFIX + b'\x00\x03')
+LATEST = 3   # index into SALT_LEN, EXPANSION_COUNT, HEADER
+
+# from this version on the header is followed by the KDF and its parameters:
+# algorithm, n (PBKDF2 iterations or scrypt cost), r and p (scrypt only)
+KDF_VERSION = 3
+KDF_PARAMS = struct.Struct('>BIHB')
+KDF_LEN = KDF_PARAMS.size
+KDF_IDS = {'pbkdf2': 1, 'scrypt': 2}
+Kdf = namedtuple('Kdf', ['name', 'n', 'r', 'p'])
+DEFAULT_KDF = Kdf('pbkdf2', EXPANSION_COUNT[LATEST], 0, 0)
+DEFAULT_SCRYPT = Kdf('scrypt', 1 << 15, 8, 1)
+# parameters are read before the HMAC can be checked, so bound the work they ask for
+MAX_PBKDF2_COUNT = 1 << 28
+# hashlib.scrypt refuses a maxmem of INT_MAX or more
+MAX_SCRYPT_MEMORY = (1 << 31) - 1
+# derived key pairs kept by a KeyCache
+KEY_CACHE_ENTRIES = 256
 
 # lengths here are in bits, but pcrypto uses block size in bytes
 HALF_BLOCK = AES.block_size*8//2
@@ -23,12 +43,65 @@ HEADER_LEN = 4
 for header in HEADER:
     assert len(header) == HEADER_LEN
 
+# header, KDF parameters and salt, in bytes
+HEAD_LEN = tuple(
+    HEADER_LEN + (KDF_LEN if version >= KDF_VERSION else 0) + SALT_LEN[version]//8
+    for version in range(len(HEADER))
+)
+
 class DecryptionException(Exception): pass
 class EncryptionException(Exception): pass
 
+def scrypt_memory(kdf):
+    '''Bytes of memory scrypt may use for kdf, as passed to hashlib.'''
+    return 128 * kdf.r * (kdf.n + kdf.p + 2) + (1 << 20)
+
+def check_kdf(kdf):
+    '''
+    Raise ValueError unless kdf can be stored in the header and derived.
+    '''
+    if kdf.name not in KDF_IDS:
+        raise ValueError(f'Unknown key derivation function {kdf.name!r}.')
+    # field ranges of KDF_PARAMS
+    if not (0 <= kdf.n < 1 << 32 and 0 <= kdf.r < 1 << 16 and 0 <= kdf.p < 1 << 8):
+        raise ValueError('KDF parameters out of range.')
+    if kdf.name == 'pbkdf2' and not 0 < kdf.n <= MAX_PBKDF2_COUNT:
+        raise ValueError(f'PBKDF2 needs 1 to {MAX_PBKDF2_COUNT} iterations.')
+    if kdf.name == 'scrypt':
+        if kdf.n < 2 or kdf.n & (kdf.n - 1) or not kdf.r or not kdf.p:
+            raise ValueError('scrypt needs n a power of two above 1, and r and p above 0.')
+        if scrypt_memory(kdf) >= MAX_SCRYPT_MEMORY:
+            raise ValueError('scrypt parameters need too much memory.')
+
+class KeyCache:
+    '''
+    Derived key pairs by password, salt and KDF, so that payloads sharing a
+    salt (the same cover read again) only pay for the derivation once.
+    '''
+    def __init__(self,max_entries=KEY_CACHE_ENTRIES) -> None:
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self,key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        return None
+
+    def put(self,key,keys):
+        with self._lock:
+            self._entries[key] = keys
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
 class Crypto:
-    def __init__(self,password) -> None:
+    def __init__(self,password,kdf=None,key_cache=None) -> None:
         self.password = password
+        self.kdf = kdf or DEFAULT_KDF
+        self.key_cache = key_cache
 
     def encrypt(self, data):
         '''
@@ -40,14 +113,15 @@ class Crypto:
         
         data = self._str_to_bytes(data)
         self._assert_encrypt_length(data)
+        header = HEADER[LATEST] + self._pack_kdf(self.kdf)
         salt = bytes(self._random_bytes(SALT_LEN[LATEST]//8))
-        hmac_key, cipher_key = self._expand_keys(self.password, salt, EXPANSION_COUNT[LATEST])
+        hmac_key, cipher_key = self._expand_keys(self.password, salt, self.kdf)
         counter = Counter.new(HALF_BLOCK, prefix=salt[:HALF_BLOCK//8])
         cipher = AES.new(cipher_key, AES.MODE_CTR, counter=counter)
         encrypted = cipher.encrypt(data)
-        hmac = self._hmac(hmac_key, HEADER[LATEST] + salt + encrypted)
+        hmac = self._hmac(hmac_key, header + salt + encrypted)
 
-        data_returned = HEADER[LATEST] + salt + encrypted + hmac
+        data_returned = header + salt + encrypted + hmac
         # print(data_returned)
         
         return data_returned
@@ -68,16 +142,63 @@ class Crypto:
         self._assert_header_prefix(data)
         version = self._assert_header_version(data)
         # version = HEADER.index(data[:HEADER_LEN])
-        self._assert_decrypt_length(data, version)
-        raw = data[HEADER_LEN:]
-        salt = raw[:SALT_LEN[version]//8]
-        hmac_key, cipher_key = self._expand_keys(self.password, salt, EXPANSION_COUNT[version])
-        hmac = raw[-HASH.digest_size:]
+        self._assert_decrypt_length(len(data), version)
+        kdf = self._read_kdf(data, version)
+        salt = data[HEAD_LEN[version] - SALT_LEN[version]//8:HEAD_LEN[version]]
+        hmac_key, cipher_key = self._expand_keys(self.password, salt, kdf)
+        hmac = data[-HASH.digest_size:]
         hmac2 = self._hmac(hmac_key, data[:-HASH.digest_size])
         self._assert_hmac(hmac_key, hmac, hmac2)
         counter = Counter.new(HALF_BLOCK, prefix=salt[:HALF_BLOCK//8])
         cipher = AES.new(cipher_key, AES.MODE_CTR, counter=counter)
-        return cipher.decrypt(raw[SALT_LEN[version]//8:-HASH.digest_size])
+        return cipher.decrypt(data[HEAD_LEN[version]:-HASH.digest_size])
+
+    def decrypt_stream(self, read_chunks, data_len):
+        '''
+        Decrypt data that arrives in chunks, yielding plaintext chunks as they
+        are produced.  The HMAC is checked over a first pass of the data before
+        any plaintext is released, so `read_chunks` is iterated twice in full
+        (and once more for the first chunk).
+        @param read_chunks: Callable returning a fresh iterable of byte chunks.
+        @param data_len: Total length of the encrypted data, in bytes.
+        @return: Generator of decrypted chunks, as bytes.
+        '''
+
+        # header, KDF parameters and salt all sit in the first chunk
+        head = b''.join(self._window(read_chunks(), 0, max(HEAD_LEN)))
+        self._assert_header_prefix(head)
+        version = self._assert_header_version(head)
+        self._assert_decrypt_length(data_len, version)
+        head_len = HEAD_LEN[version]
+        kdf = self._read_kdf(head, version)
+        salt = head[head_len - SALT_LEN[version]//8:head_len]
+        hmac_key, cipher_key = self._expand_keys(self.password, salt, kdf)
+        # one pass feeds the MAC and keeps the trailing HMAC
+        mac_end = data_len - HASH.digest_size
+        mac = HMAC.new(hmac_key, digestmod=HASH)
+        hmac = b''
+        offset = 0
+        for part in self._window(read_chunks(), 0, data_len):
+            split = max(min(mac_end - offset, len(part)), 0)
+            mac.update(part[:split])
+            hmac += part[split:]
+            offset += len(part)
+        self._assert_hmac(hmac_key, hmac, mac.digest())
+        counter = Counter.new(HALF_BLOCK, prefix=salt[:HALF_BLOCK//8])
+        cipher = AES.new(cipher_key, AES.MODE_CTR, counter=counter)
+        for part in self._window(read_chunks(), head_len, mac_end):
+            yield cipher.decrypt(part)
+
+    def _window(self, chunks, start, stop):
+        # yield the parts of a chunked byte stream that fall in [start, stop)
+        offset = 0
+        for chunk in chunks:
+            end = offset + len(chunk)
+            if end > start:
+                yield bytes(chunk[max(start - offset, 0):stop - offset])
+            offset = end
+            if offset >= stop:
+                break
 
     def _assert_not_unicode(self,data):
         # warn confused users
@@ -91,8 +212,8 @@ class Crypto:
         if len(data) > 2**HALF_BLOCK:
             raise EncryptionException('Message too long.')
 
-    def _assert_decrypt_length(self,data, version):
-        if len(data) < HEADER_LEN + SALT_LEN[version]//8 + HASH.digest_size:
+    def _assert_decrypt_length(self,data_len, version):
+        if data_len < HEAD_LEN[version] + HASH.digest_size:
             raise DecryptionException('Missing data.')
         
     def _assert_header_prefix(self,data):
@@ -115,17 +236,48 @@ class Crypto:
         if self._hmac(key, hmac) != self._hmac(key, hmac2):
             raise DecryptionException('Bad password or corrupt / modified data.')
 
+    def _pack_kdf(self,kdf):
+        return KDF_PARAMS.pack(KDF_IDS[kdf.name], kdf.n, kdf.r, kdf.p)
+
+    def _read_kdf(self,data, version):
+        if version < KDF_VERSION:
+            return Kdf('pbkdf2', EXPANSION_COUNT[version], 0, 0)
+        kdf_id, n, r, p = KDF_PARAMS.unpack_from(data, HEADER_LEN)
+        names = {v: k for k, v in KDF_IDS.items()}
+        if kdf_id not in names:
+            raise DecryptionException('Unknown key derivation function (bad header).')
+        kdf = Kdf(names[kdf_id], n, r, p)
+        try:
+            check_kdf(kdf)
+        except ValueError as e:
+            raise DecryptionException(f'{e} (bad header)')
+        return kdf
+
     def _pbkdf2(self,password,salt, n_bytes, count):
-        # the form of the prf below is taken from the code for PBKDF2
-        return PBKDF2(password, salt, dkLen=n_bytes,
-                    count=count, prf=lambda p,s: HMAC.new(p,s,HASH).digest())
+        # native HMAC-SHA256 PBKDF2, same output as PyCryptodome's PBKDF2 with an HMAC prf
+        return hashlib.pbkdf2_hmac(HASH_NAME, password, salt, count, n_bytes)
+
+    def _scrypt(self,password,salt, n_bytes, kdf):
+        return hashlib.scrypt(password, salt=salt, n=kdf.n, r=kdf.r, p=kdf.p,
+                              maxmem=scrypt_memory(kdf), dklen=n_bytes)
 
-    def _expand_keys(self,password,salt, expansion_count):
+    def _expand_keys(self,password,salt, kdf):
         if not salt: raise ValueError('Missing salt.')
         if not self.password: raise ValueError('Missing password.')
+        cache_key = (self._str_to_bytes(password), bytes(salt), kdf)
+        if self.key_cache is not None:
+            keys = self.key_cache.get(cache_key)
+            if keys is not None:
+                return keys
         key_len = AES_KEY_LEN // 8
-        keys = self._pbkdf2(self._str_to_bytes(password), salt, 2*key_len, expansion_count)
-        return keys[:key_len], keys[key_len:]
+        if kdf.name == 'scrypt':
+            keys = self._scrypt(self._str_to_bytes(password), salt, 2*key_len, kdf)
+        else:
+            keys = self._pbkdf2(self._str_to_bytes(password), salt, 2*key_len, kdf.n)
+        keys = keys[:key_len], keys[key_len:]
+        if self.key_cache is not None:
+            self.key_cache.put(cache_key, keys)
+        return keys
 
     def _hide(self,ranbytes):
         # appelbaum recommends obscuring output from random number generators since it can reveal state.
@@ -144,3 +296,54 @@ class Crypto:
         if isinstance(data, u_type):
             return data.encode('utf8')
         return data
+
+
+def parse_kdf(spec):
+    '''
+    Parse a KDF description such as `pbkdf2:n=600000` or `scrypt:n=32768,r=8,p=1`.
+    Missing parameters take their defaults.
+    '''
+    name, _, params = spec.partition(':')
+    if name not in KDF_IDS:
+        raise ValueError(f'Unknown key derivation function {name!r}.')
+    kdf = DEFAULT_SCRYPT if name == 'scrypt' else DEFAULT_KDF
+    values = dict(param.split('=', 1) for param in params.split(',') if param)
+    if not set(values) <= {'n', 'r', 'p'}:
+        raise ValueError(f'Unknown KDF parameters in {spec!r}.')
+    kdf = kdf._replace(**{key: int(value) for key, value in values.items()})
+    # rejected here rather than when the volume is hidden at unmount
+    check_kdf(kdf)
+    return kdf
+
+def format_kdf(kdf):
+    if kdf.name == 'scrypt':
+        return f'scrypt:n={kdf.n},r={kdf.r},p={kdf.p}'
+    return f'pbkdf2:n={kdf.n}'
+
+def calibrate(name='pbkdf2', target=1.0):
+    '''
+    Pick parameters for the named KDF so that deriving the keys takes about
+    `target` seconds on this machine.
+    @return: The calibrated Kdf.
+    '''
+    crypto = Crypto('calibration')
+    salt = bytes(SALT_LEN[LATEST]//8)
+    kdf = Kdf('pbkdf2', 10000, 0, 0) if name == 'pbkdf2' else DEFAULT_SCRYPT._replace(n=1 << 10)
+    while True:
+        start = perf_counter()
+        crypto._expand_keys(crypto.password, salt, kdf)
+        elapsed = perf_counter() - start
+        if elapsed >= min(0.2, target / 2):
+            break
+        if name == 'scrypt' and scrypt_memory(kdf._replace(n=kdf.n * 2)) >= MAX_SCRYPT_MEMORY:
+            break
+        kdf = kdf._replace(n=kdf.n * 2)
+    # both KDFs scale linearly with n
+    n = kdf.n * target / elapsed
+    if name == 'pbkdf2':
+        return kdf._replace(n=min(max(int(n), 1000), MAX_PBKDF2_COUNT))
+    # scrypt needs a power of two
+    n = 1 << max(round(n).bit_length() - 1, 1)
+    while scrypt_memory(kdf._replace(n=n)) >= MAX_SCRYPT_MEMORY:
+        n >>= 1
+    return kdf._replace(n=n)
@@ -0,0 +1,269 @@
+import os,json,stat,socket,struct,logging,threading,socketserver
+
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from cache import carrier_cache
+from crypto import KeyCache, parse_kdf
+from probe import detect_num_lsb, probe_image
+from steganography import Steg
+
+log = logging.getLogger(__name__)
+
+# Every message is a JSON header frame followed by body frames and an empty
+# frame; a frame is a big endian u32 length and that many bytes.
+# Requests:  {"op": "embed", "picture", "password", "num_lsb"?, "kdf"?} + message
+#            {"op": "extract", "picture", "password", "num_lsb"?}
+#            {"op": "probe", "picture"}
+# Responses: {"ok": true, ...} + payload, or {"ok": false, "error": "..."}
+LENGTH = struct.Struct('>I')
+# payload bytes per body frame
+FRAME_SIZE = 1 << 20
+# seconds a connection may sit idle (or stall mid-message) before it is closed
+IDLE_TIMEOUT = 300
+
+
+class DaemonError(Exception): pass
+
+
+def send_frame(f, data):
+    f.write(LENGTH.pack(len(data)))
+    f.write(data)
+
+
+def recv_frame(f):
+    """Returns the next frame, or None at a clean end of stream."""
+    head = f.read(LENGTH.size)
+    if not head:
+        return None
+    if len(head) < LENGTH.size:
+        raise DaemonError('Truncated frame.')
+    (length,) = LENGTH.unpack(head)
+    data = f.read(length)
+    if len(data) < length:
+        raise DaemonError('Truncated frame.')
+    return data
+
+
+def send_header(f, header):
+    send_frame(f, json.dumps(header).encode('utf8'))
+
+
+def send_body(f, chunks=()):
+    for chunk in chunks:
+        for start in range(0, len(chunk), FRAME_SIZE):
+            send_frame(f, chunk[start:start + FRAME_SIZE])
+    send_frame(f, b'')
+    f.flush()
+
+
+def send_message(f, header, chunks=()):
+    send_header(f, header)
+    send_body(f, chunks)
+
+
+def recv_header(f):
+    frame = recv_frame(f)
+    if frame is None:
+        return None
+    return json.loads(frame.decode('utf8'))
+
+
+def recv_body(f):
+    """Yields the body frames of the current message."""
+    while True:
+        frame = recv_frame(f)
+        if frame is None:
+            raise DaemonError('Connection closed in the middle of a message.')
+        if not frame:
+            return
+        yield frame
+
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+    """Reads requests off one connection. The work itself runs on the
+    server's pool, so an idle connection only holds its own thread."""
+
+    timeout = IDLE_TIMEOUT
+
+    def setup(self):
+        super().setup()
+        self.server.track(self.request, True)
+
+    def finish(self):
+        self.server.track(self.request, False)
+        super().finish()
+
+    def handle(self):
+        try:
+            self._serve_requests()
+        except ConnectionError as e:
+            log.debug('client went away: %s', e)
+        except TimeoutError:
+            log.debug('closing idle connection')
+
+    def _serve_requests(self):
+        # a connection may carry any number of requests
+        while True:
+            request = recv_header(self.rfile)
+            if request is None:
+                return
+            body = b''.join(recv_body(self.rfile))
+            self.replied = False
+            try:
+                self.server.executor.submit(self._reply, request, body).result()
+            except Exception as e:
+                if self.replied or isinstance(e, ConnectionError):
+                    # the body is cut short, a second header would break the
+                    # framing; dropping the connection tells the client
+                    log.warning('%s reply failed, closing the connection: %s', request.get('op'), e)
+                    return
+                log.exception('%s request failed', request.get('op'))
+                send_message(self.wfile, {'ok': False, 'error': str(e)})
+
+    def _reply(self, request, body):
+        with self.server.lock_for(request.get('picture')):
+            header, chunks = self.server.dispatch(request, body)
+            send_header(self.wfile, dict(header, ok=True))
+            self.replied = True
+            send_body(self.wfile, chunks)
+
+
+class Daemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Serves embed/extract/probe requests on a Unix socket, keeping derived
+    keys and decoded covers warm between requests."""
+
+    # one thread per connection, which must not keep the process alive
+    daemon_threads = True
+
+    def __init__(self, path, workers=None, cache=None, encoder=None) -> None:
+        # runs the requests; connections are served by their own threads
+        self.executor = ThreadPoolExecutor(workers)
+        self.carrier_cache = cache or carrier_cache
+        self.encoder = encoder
+        self.key_cache = KeyCache()
+        # picture -> [lock, requests holding or waiting for it]
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        # open connections, shut down with the server
+        self._connections = set()
+        if os.path.lexists(path):
+            # a daemon that did not shut down cleanly leaves its socket behind
+            if not stat.S_ISSOCK(os.lstat(path).st_mode):
+                raise FileExistsError(f'{path} exists and is not a socket')
+            os.remove(path)
+        # requests carry passwords, only the owner may connect
+        umask = os.umask(0o077)
+        try:
+            super().__init__(path, DaemonHandler)
+        finally:
+            os.umask(umask)
+
+    def track(self, connection, opened):
+        with self._locks_lock:
+            if opened:
+                self._connections.add(connection)
+            else:
+                self._connections.discard(connection)
+
+    def server_close(self):
+        super().server_close()
+        with self._locks_lock:
+            connections = list(self._connections)
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.executor.shutdown(wait=False)
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+    @contextmanager
+    def lock_for(self, picture):
+        """Serializes requests on the same cover. A picture's lock is
+        dropped once no request holds or waits for it."""
+        key = os.path.realpath(picture) if picture else None
+        with self._locks_lock:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._locks_lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
+
+    def dispatch(self, request, body):
+        op = request.get('op')
+        picture = request['picture']
+        if op == 'probe':
+            return {'candidates': [list(c) for c in probe_image(picture)]}, ()
+
+        kdf = parse_kdf(request['kdf']) if request.get('kdf') else None
+        steg = Steg(
+            request['password'], picture, None,
+            num_lsb=request.get('num_lsb') or detect_num_lsb(picture),
+            cache=self.carrier_cache, kdf=kdf, key_cache=self.key_cache,
+            encoder=self.encoder,
+        )
+        if op == 'embed':
+            steg.hide_message_in_image(body)
+            return {}, ()
+        if op == 'extract':
+            chunks = steg.iter_decrypted_message(picture)
+            # authentication happens before the first chunk, fail before replying
+            first = next(chunks, b'')
+            return {}, chain([first], chunks)
+        raise DaemonError(f'Unknown operation {op!r}.')
+
+
+class DaemonClient():
+    """Thin client for a Daemon listening on path."""
+
+    def __init__(self, path) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.rfile = self.sock.makefile('rb')
+        self.wfile = self.sock.makefile('wb')
+
+    def _call(self, request, body=b''):
+        # the daemon resolves paths against its own working directory
+        request['picture'] = os.path.abspath(request['picture'])
+        send_message(self.wfile, request, [body])
+        header = recv_header(self.rfile)
+        if header is None:
+            raise DaemonError('Connection closed by the daemon.')
+        if not header.pop('ok'):
+            # error replies still end with an empty body
+            for _ in recv_body(self.rfile):
+                pass
+            raise DaemonError(header['error'])
+        return header
+
+    def embed(self, picture, password, message, num_lsb=None, kdf=None):
+        request = {'op': 'embed', 'picture': picture, 'password': password, 'num_lsb': num_lsb}
+        if kdf is not None:
+            request['kdf'] = kdf
+        self._call(request, message)
+        for _ in recv_body(self.rfile):
+            pass
+
+    def extract(self, picture, password, num_lsb=None):
+        """Yields the decrypted payload in chunks as the daemon sends them.
+        The chunks must be consumed before the next request."""
+        self._call({'op': 'extract', 'picture': picture, 'password': password, 'num_lsb': num_lsb})
+        return recv_body(self.rfile)
+
+    def probe(self, picture):
+        candidates = self._call({'op': 'probe', 'picture': picture})['candidates']
+        for _ in recv_body(self.rfile):
+            pass
+        return candidates
+
+    def close(self):
+        self.rfile.close()
+        self.wfile.close()
+        self.sock.close()
@@ -0,0 +1,183 @@
+import os,io,logging,threading
+
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from time import perf_counter
+from PIL import Image
+
+log = logging.getLogger(__name__)
+
+# Policies for writing a single-frame carrier:
+#   level:N       save with a fixed compression level (the historic behaviour)
+#   fastest       store without compression
+#   smallest:MS   encode with several settings in parallel and keep the
+#                 smallest file finished within MS milliseconds
+#   background:N  store without compression, then recompress at level N in
+#                 a background thread and swap the file in atomically
+POLICIES = ('level', 'fastest', 'smallest', 'background')
+DEFAULT_LEVEL = 1
+DEFAULT_BUDGET_MS = 500
+BACKGROUND_LEVEL = 9
+
+# save options tried by `smallest`, fastest first; zlib releases the GIL so
+# the PNG candidates really run in parallel. compress_type is the zlib strategy.
+CANDIDATES = {
+    'PNG': [
+        {'compress_level': 1},
+        {'compress_level': 6},
+        {'compress_level': 6, 'compress_type': 1},
+        {'compress_level': 6, 'compress_type': 3},
+        {'compress_level': 9},
+        {'compress_level': 9, 'compress_type': 1},
+    ],
+    'TIFF': [
+        {'compression': 'raw'},
+        {'compression': 'packbits'},
+        {'compression': 'tiff_lzw'},
+        {'compression': 'tiff_adobe_deflate'},
+    ],
+}
+# uncompressed (or as good as) save options per format
+FASTEST = {'PNG': {'compress_level': 0}, 'TIFF': {'compression': 'raw'}}
+
+EncodeReport = namedtuple('EncodeReport', ['policy', 'format', 'options', 'seconds', 'size', 'tried'])
+
+
+def image_format(image, path):
+    """Returns the format PIL would save path in."""
+    ext = os.path.splitext(path)[1].lower()
+    return Image.registered_extensions().get(ext) or image.format or 'PNG'
+
+
+def level_options(fmt, level):
+    if fmt == 'PNG':
+        return {'compress_level': level}
+    if fmt == 'TIFF':
+        # TIFF has no levels; carriers used to be written raw at the default
+        return {'compression': 'tiff_adobe_deflate' if level > DEFAULT_LEVEL else 'raw'}
+    return {}
+
+
+def _encode(image, fmt, options):
+    buffer = io.BytesIO()
+    image.save(buffer, format=fmt, **options)
+    return options, buffer.getbuffer()
+
+
+def _write(path, data):
+    """Replaces path with data, so readers never see a partial file."""
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class Encoder():
+    """Writes carriers according to one of POLICIES and remembers how the
+    last one went in `report`."""
+
+    def __init__(self, policy='level', level=None, budget_ms=None, workers=None) -> None:
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown encoder policy {policy!r}.')
+        self.policy = policy
+        default = BACKGROUND_LEVEL if policy == 'background' else DEFAULT_LEVEL
+        self.level = default if level is None else level
+        self.budget_ms = DEFAULT_BUDGET_MS if budget_ms is None else budget_ms
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='encoder')
+        self.report = None
+        # background recompressions still running, by path
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def save(self, image, path, on_replace=None):
+        """Writes image to path and returns an EncodeReport. With the
+        background policy, on_replace is called once the recompressed file
+        has replaced the first one."""
+        fmt = image_format(image, path)
+        start = perf_counter()
+        if self.policy == 'smallest' and fmt in CANDIDATES:
+            options, data, tried = self._smallest(image, fmt)
+        else:
+            if self.policy in ('fastest', 'background'):
+                options = FASTEST.get(fmt, {})
+            else:
+                options = level_options(fmt, self.level)
+            options, data = _encode(image, fmt, options)
+            tried = 1
+        with self._lock:
+            # never interleaved with a background recompression of path
+            _write(path, data)
+            stat = os.stat(path)
+        self.report = EncodeReport(self.policy, fmt, options, perf_counter() - start, len(data), tried)
+        log.info('encoded %s as %s %s: %d bytes in %.3fs (%d tried)',
+                 path, fmt, options, len(data), self.report.seconds, tried)
+
+        if self.policy == 'background' and fmt in FASTEST:
+            written = (stat.st_mtime_ns, stat.st_size)
+            self._recompress_later(image.copy(), fmt, path, written, on_replace)
+        return self.report
+
+    def _smallest(self, image, fmt):
+        """Encodes with every candidate at once and returns the smallest
+        result finished within the budget, or the first one if none was."""
+        # PIL keeps the save options on the image, so every encode gets a copy
+        futures = [
+            self.executor.submit(_encode, image.copy(), fmt, options) for options in CANDIDATES[fmt]
+        ]
+        done, _ = wait(futures, timeout=self.budget_ms / 1000)
+        if not done:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+        # the rest finish in the background and are dropped
+        for future in futures:
+            future.cancel()
+        options, data = min((f.result() for f in done), key=lambda result: len(result[1]))
+        return options, data, len(done)
+
+    def _recompress_later(self, image, fmt, path, written, on_replace):
+        with self._lock:
+            previous = self._pending.get(path)
+            if previous is not None:
+                # a newer carrier supersedes the one still being recompressed
+                previous.cancel()
+            self._pending[path] = self.executor.submit(
+                self._recompress, image, fmt, path, written, on_replace
+            )
+
+    def _recompress(self, image, fmt, path, written, on_replace):
+        start = perf_counter()
+        options, data = _encode(image, fmt, level_options(fmt, self.level))
+        with self._lock:
+            stat = os.stat(path)
+            if (stat.st_mtime_ns, stat.st_size) != written:
+                log.debug('%s changed while it was recompressed, keeping it', path)
+                return
+            _write(path, data)
+            self._pending.pop(path, None)
+        log.info('recompressed %s as %s %s: %d bytes in %.3fs',
+                 path, fmt, options, len(data), perf_counter() - start)
+        if on_replace is not None:
+            on_replace()
+
+    def join(self):
+        """Blocks until the background recompressions are done."""
+        with self._lock:
+            pending = list(self._pending.values())
+        wait(pending)
+
+
+def parse_encoder(spec):
+    '''
+    Parse an encoder description such as `level:6`, `fastest`,
+    `smallest:500` (milliseconds) or `background:9`.
+    '''
+    policy, _, value = spec.partition(':')
+    if policy not in POLICIES:
+        raise ValueError(f'Unknown encoder policy {policy!r}.')
+    value = int(value) if value else None
+    if policy == 'smallest':
+        return Encoder(policy, budget_ms=value)
+    return Encoder(policy, level=value)
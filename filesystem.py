@@ -36,26 +36,67 @@ from os import fsencode, fsdecode
 from collections import defaultdict
 from PIL import Image
 from steganography import Steg
-from utils import str_to_bytes
+from volume import (
+    gather_files, gather_links, pack_files, is_volume, unpack_files, unpack_links,
+    write_files, write_links, clear_files
+)
 from numpy import array
 
 faulthandler.enable()
 
 log = logging.getLogger(__name__)
 
+# a file's pending writes are written out once they grow past this
+WRITE_BUFFER_SIZE = 1024 * 1024
+# all pending writes are written out once together they grow past this
+WRITE_BUFFER_LIMIT = 64 * 1024 * 1024
+
+class WriteBuffer():
+    """Adjacent and overlapping writes to one file descriptor, merged into
+    a single contiguous range."""
+
+    def __init__(self, offset, buf) -> None:
+        self.offset = offset
+        self.data = bytearray(buf)
+
+    @property
+    def end(self):
+        return self.offset + len(self.data)
+
+    def touches(self, offset, length):
+        """True if [offset, offset+length) overlaps or is adjacent to the buffer."""
+        return offset <= self.end and offset + length >= self.offset
+
+    def merge(self, offset, buf):
+        start = offset - self.offset
+        if start < 0:
+            # the new write covers the gap in front of the buffer
+            self.data[:0] = bytes(-start)
+            self.offset = offset
+            start = 0
+        self.data[start:start + len(buf)] = buf
+
 class Operations(pyfuse3.Operations,Steg):
 
     enable_writeback_cache = True
 
-    def __init__(self, source,passwd,input_image_path,output_file_path):
-        super().__init__(passwd,input_image_path,output_file_path)
+    def __init__(self, source,passwd,input_image_path,output_file_path,
+                 write_buffer_size=WRITE_BUFFER_SIZE,write_buffer_limit=WRITE_BUFFER_LIMIT,cache=None,kdf=None,encoder=None):
+        super().__init__(passwd,input_image_path,output_file_path,cache=cache,kdf=kdf,encoder=encoder)
         # Steg.__init__(self, passwd,input_image_path,output_file_path)
+        self._init_passthrough(source,write_buffer_size,write_buffer_limit)
+        self.main_()
+
+    def _init_passthrough(self, source, write_buffer_size, write_buffer_limit):
         self._inode_path_map = { pyfuse3.ROOT_INODE: source }
         self._lookup_cnt = defaultdict(lambda : 0)
         self._fd_inode_map = dict()
         self._inode_fd_map = dict()
         self._fd_open_count = dict()
-        self.main_()
+        self._write_buffers = dict()
+        self._buffered_bytes = 0
+        self.write_buffer_size = write_buffer_size
+        self.write_buffer_limit = write_buffer_limit
     
     def main_(self):
         try:
@@ -131,6 +172,8 @@ class Operations(pyfuse3.Operations,Steg):
 
     async def getattr(self, inode, ctx=None):
         if inode in self._inode_fd_map:
+            # pending writes may change the size
+            self._flush_fd(self._inode_fd_map[inode])
             return self._getattr(fd=self._inode_fd_map[inode])
         else:
             return self._getattr(path=self._inode_to_path(inode))
@@ -287,6 +330,8 @@ class Operations(pyfuse3.Operations,Steg):
         # We use the f* functions if possible so that we can handle
         # a setattr() call for an inode without associated directory
         # handle.
+        if inode in self._inode_fd_map:
+            self._flush_fd(self._inode_fd_map[inode])
         if fh is None:
             path_or_fh = self._inode_to_path(inode)
             truncate = os.truncate
@@ -408,18 +453,95 @@ class Operations(pyfuse3.Operations,Steg):
         return (pyfuse3.FileInfo(fh=fd), attr)
 
     async def read(self, fd, offset, length):
-        os.lseek(fd, offset, os.SEEK_SET)
-        return os.read(fd, length)
+        buffered = self._write_buffers.get(fd)
+        if buffered is not None and buffered.touches(offset, length):
+            self._flush_fd(fd)
+        try:
+            return os.pread(fd, length, offset)
+        except OSError as exc:
+            raise FUSEError(exc.errno)
 
     async def write(self, fd, offset, buf):
-        os.lseek(fd, offset, os.SEEK_SET)
-        return os.write(fd, buf)
+        buffered = self._write_buffers.get(fd)
+        if buffered is not None and not buffered.touches(offset, len(buf)):
+            self._flush_fd(fd)
+            buffered = None
+
+        if buffered is None:
+            if len(buf) >= self.write_buffer_size:
+                self._pwrite(fd, buf, offset)
+                return len(buf)
+            buffered = self._write_buffers[fd] = WriteBuffer(offset, buf)
+            self._buffered_bytes += len(buffered.data)
+        else:
+            before = len(buffered.data)
+            buffered.merge(offset, buf)
+            self._buffered_bytes += len(buffered.data) - before
+
+        if len(buffered.data) >= self.write_buffer_size:
+            self._flush_fd(fd)
+        elif self._buffered_bytes > self.write_buffer_limit:
+            self._flush_all()
+        return len(buf)
+
+    def _pwrite(self, fd, buf, offset):
+        view = memoryview(buf)
+        try:
+            while view:
+                written = os.pwrite(fd, view, offset)
+                view = view[written:]
+                offset += written
+        except OSError as exc:
+            raise FUSEError(exc.errno)
+
+    def _flush_fd(self, fd):
+        buffered = self._write_buffers.get(fd)
+        if buffered is None:
+            return
+        # the buffer is kept until it is written, so a failed write (ENOSPC,
+        # EIO) is reported again by the next flush, fsync or release
+        self._pwrite(fd, buffered.data, buffered.offset)
+        del self._write_buffers[fd]
+        self._buffered_bytes -= len(buffered.data)
+
+    def _flush_all(self):
+        for fd in list(self._write_buffers):
+            try:
+                self._flush_fd(fd)
+            except FUSEError as exc:
+                # left buffered, the fd's own flush or release reports it
+                log.warning('could not write out fd %d: %s', fd, os.strerror(exc.errno))
+
+    async def flush(self, fd):
+        self._flush_fd(fd)
+
+    async def fsync(self, fd, datasync):
+        self._flush_fd(fd)
+        try:
+            if datasync:
+                os.fdatasync(fd)
+            else:
+                os.fsync(fd)
+        except OSError as exc:
+            raise FUSEError(exc.errno)
 
     async def release(self, fd):
         if self._fd_open_count[fd] > 1:
             self._fd_open_count[fd] -= 1
+            # a failed write stays buffered for the other openers
+            self._flush_fd(fd)
             return
 
+        try:
+            self._flush_fd(fd)
+        finally:
+            # the fd is closed either way, what could not be written is lost
+            buffered = self._write_buffers.pop(fd, None)
+            if buffered is not None:
+                self._buffered_bytes -= len(buffered.data)
+            self._close_fd(fd)
+
+    def _close_fd(self, fd):
         del self._fd_open_count[fd]
         inode = self._fd_inode_map[fd]
         del self._inode_fd_map[inode]
@@ -429,33 +551,26 @@ class Operations(pyfuse3.Operations,Steg):
         except OSError as exc:
             raise FUSEError(exc.errno)
     
-    def check_file(self):
-        print('checking files')
-        your_path = self.output_file_path
-        files = self.listdir(pyfuse3.ROOT_INODE)
-        for file in files:
-            print('hiding file: ',file)
-            if os.path.isfile(os.path.join(your_path, file)):
-                yield open(os.path.join(your_path, file), "rb")
-    
     def hide_data(self):
         """Hides the data from the input file in the input image."""
         print("hiding data to image")
 
         if self.input_image_path is None:
             raise ValueError("LSBSteg hiding requires an input image file path")
+
+        self._flush_all()
         
-        message = str_to_bytes('')
-        for i,input_file in enumerate(self.check_file()):
-            seq = str_to_bytes(f'/{str(i).zfill(2)}/')
-            message += str_to_bytes(input_file.name.split('/')[-1]) + seq + str_to_bytes(input_file.read()) + seq
-            input_file.close()
+        # the whole tree is read in parallel into a single buffer
+        files = gather_files(self.output_file_path)
+        for name, _ in files:
+            print('hiding file: ',name)
+
+        # identical chunks across files are stored once
+        message = pack_files(files, gather_links(self.output_file_path))
 
         self.hide_message_in_image(message)
         
-        for i in self.listdir(pyfuse3.ROOT_INODE):
-            print('removing',i)
-            os.remove(os.path.join(self.output_file_path, i))
+        clear_files(self.output_file_path)
         
         raise Exception('done hiding')
 
@@ -468,10 +583,15 @@ class Operations(pyfuse3.Operations,Steg):
             raise ValueError("LSBSteg recovery requires an output file path")
 
         steg_image = self.prepare_recover()
-        data = self.recover_message_from_image(steg_image)
-        # print(data)
+        data = self.cry.decrypt(self.recover_message_from_image(steg_image))
+
+        if is_volume(data):
+            write_files(self.output_file_path, unpack_files(data))
+            write_links(self.output_file_path, unpack_links(data))
+            raise Exception('Recovery complete')
 
-        data = self.cry.decrypt(data).decode('utf-8')
+        # payloads hidden before volumes were introduced
+        data = data.decode('utf-8')
 
         data = ''.join(data.replace('\n',''))
         
@@ -0,0 +1,131 @@
+import os
+from bisect import bisect_right
+
+import numpy as np
+from PIL import Image, TiffImagePlugin
+from utils import lsb_values
+
+# formats whose frames we can write back without losing pixel values; GIF
+# frames are palette based, so RGB LSBs would not survive re-quantization
+MULTIFRAME_FORMATS = ('TIFF', 'PNG')
+# TIFF compressions that keep pixel values intact
+LOSSLESS_TIFF = ('raw', 'tiff_lzw', 'tiff_deflate', 'tiff_adobe_deflate', 'packbits')
+# frame modes whose values are 8 bit and round trip through Image.fromarray;
+# they also hold at least the 3 values per pixel the capacity assumes
+FRAME_MODES = ('RGB', 'RGBA')
+
+
+def is_multiframe(image):
+    return getattr(image, 'n_frames', 1) > 1
+
+
+class FrameCarrier():
+    """Color values of every frame of a multi-page TIFF or animated PNG,
+    indexed as if the flattened frames were concatenated in order. Only one
+    decoded frame is held at a time."""
+
+    def __init__(self, image) -> None:
+        self.image = image
+        bands = len(image.getbands())
+        if image.format == 'PNG':
+            # APNG frames all share the canvas size and mode
+            sizes = [image.size] * image.n_frames
+            modes = {image.mode}
+        else:
+            sizes = []
+            modes = set()
+            for index in range(image.n_frames):
+                image.seek(index)
+                sizes.append(image.size)
+                modes.add(image.mode)
+            image.seek(0)
+        if not modes <= set(FRAME_MODES) or len(modes) > 1:
+            raise ValueError(f"Frames must all be one of {', '.join(FRAME_MODES)}, not {', '.join(sorted(modes))}")
+        self.pixel_count = sum(w * h for w, h in sizes)
+        self.starts = np.cumsum([0] + [w * h * bands for w, h in sizes]).tolist()
+        self._frame = (None, None)
+
+    def __len__(self):
+        return self.starts[-1]
+
+    def _frame_values(self, index):
+        if self._frame[0] != index:
+            if self.image.format == 'PNG' and index < self.image.tell():
+                # PIL cannot always rewind an APNG, start from a fresh decoder
+                self.image = Image.open(self.image.filename)
+            self.image.seek(index)
+            self._frame = (index, np.asarray(self.image, dtype=np.uint8).reshape(-1))
+        return self._frame[1]
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            raise TypeError('FrameCarrier only supports slicing')
+        start, stop, _ = key.indices(len(self))
+        parts = []
+        index = bisect_right(self.starts, start) - 1
+        while start < stop:
+            end = min(stop, self.starts[index + 1])
+            offset = self.starts[index]
+            parts.append(self._frame_values(index)[start - offset:end - offset])
+            start = end
+            index += 1
+        if not parts:
+            return np.empty(0, dtype=np.uint8)
+        return np.concatenate(parts)
+
+
+def embed_frames(image, payload, num_lsb):
+    """Yields the frames of image, one at a time, with payload interleaved
+    into the num_lsb LSBs of their color values in frame order."""
+    values = lsb_values(payload, num_lsb)
+    mask = np.uint8((0xff << num_lsb) & 0xff)
+    start = 0
+    for index in range(image.n_frames):
+        image.seek(index)
+        if start < len(values):
+            pixels = np.array(image, dtype=np.uint8)
+            flat = pixels.reshape(-1)
+            count = min(len(flat), len(values) - start)
+            flat[:count] = (flat[:count] & mask) | values[start:start + count]
+            start += len(flat)
+            frame = Image.fromarray(pixels)
+            frame.info = dict(image.info)
+        else:
+            # past the payload, the frame is passed through untouched
+            frame = image.copy()
+        yield frame
+    if start < len(values):
+        # the capacity check should have caught this, never drop payload
+        raise ValueError(f'{len(values) - start} payload values did not fit in the frames')
+
+
+def save_frames(image, frames, path):
+    """Writes frames in the format of image to path, replacing it only once
+    the new file is complete."""
+    tmp_path = path + '.tmp'
+    try:
+        if image.format == 'TIFF':
+            compression = image.info.get('compression', 'raw')
+            if compression not in LOSSLESS_TIFF:
+                compression = 'raw'
+            # pages are encoded and appended as they come
+            with TiffImagePlugin.AppendingTiffWriter(tmp_path, True) as tf:
+                for frame in frames:
+                    frame.save(tf, format='TIFF', compression=compression)
+                    tf.newFrame()
+        elif image.format == 'PNG':
+            # the APNG encoder walks append_images twice and keeps every frame
+            # to compute deltas, so frames cannot be streamed here
+            first, *rest = frames
+            first.save(tmp_path, format='PNG', save_all=True, append_images=rest,
+                       loop=image.info.get('loop', 0))
+            # identical consecutive frames are merged by the encoder, which
+            # would shift the payload
+            if Image.open(tmp_path).n_frames != image.n_frames:
+                raise ValueError('Frames were merged while saving the animated PNG')
+        else:
+            raise ValueError(f'{image.format} carriers with several frames are not supported')
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
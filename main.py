@@ -1,10 +1,14 @@
 
 from threading import Thread
 from steganography import Steg
-from filesystem import Operations
+from probe import detect_num_lsb, scan_directory
+from cache import CarrierCache
+from crypto import calibrate, format_kdf, parse_kdf
+from encoder import parse_encoder
+from daemon import Daemon, DaemonClient
 from argparse import ArgumentParser
 
-import trio,logging,sys,pyfuse3
+import logging,sys
 
 # enable logging output
 logging.basicConfig(format="%(message)s", level=logging.INFO)
@@ -27,30 +31,171 @@ def init_logging(debug=False):
         root_logger.setLevel(logging.INFO)
     root_logger.addHandler(handler)
 
+COMMANDS = ('mount', 'mount-many', 'extract', 'scan', 'calibrate', 'daemon', 'client')
+
 def parse_args(args):
     '''Parse command line'''
 
     parser = ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
 
-    parser.add_argument('source', type=str,
+    mount = subparsers.add_parser('mount', help='Mount the hidden volume')
+    mount.add_argument('source', type=str,
                         help='Directory tree to mirror')
-    parser.add_argument('mountpoint', type=str,
+    mount.add_argument('mountpoint', type=str,
                         help='Where to mount the file system')
-    parser.add_argument('password', type=str,
+    mount.add_argument('password', type=str,
                         help='password to enc/dec')
-    parser.add_argument('picture', type=str,
+    mount.add_argument('picture', type=str,
                         help='picture"s path to embed')
-    # parser.add_argument('--debug', action='store_true', default=False,
+    mount.add_argument('--cache-dir', type=str, default=None,
+                        help='directory for decoded carriers reused between runs')
+    mount.add_argument('--kdf', type=parse_kdf, default=None,
+                        help='key derivation for the hidden data, e.g. pbkdf2:n=600000 or scrypt:n=32768,r=8,p=1')
+    mount.add_argument('--encoder', type=parse_encoder, default=None,
+                        help='how the picture is written back: level:N, fastest, smallest:MS or background:N')
+    # mount.add_argument('--debug', action='store_true', default=False,
     #                     help='Enable debugging output')
-    # parser.add_argument('--debug-fuse', action='store_true', default=False,
+    # mount.add_argument('--debug-fuse', action='store_true', default=False,
     #                     help='Enable FUSE debugging output')
 
+    mount_many = subparsers.add_parser('mount-many', help='Mount several hidden volumes as subdirectories of one mount')
+    mount_many.add_argument('config', type=str,
+                        help='JSON file listing the root, mountpoint and volumes')
+    mount_many.add_argument('--workers', type=int, default=None,
+                        help='number of volumes checkpointed at once')
+    mount_many.add_argument('--cache-dir', type=str, default=None,
+                        help='directory for decoded carriers reused between runs')
+    mount_many.add_argument('--encoder', type=parse_encoder, default=None,
+                        help='how pictures are written back: level:N, fastest, smallest:MS or background:N')
+
+    extract = subparsers.add_parser('extract', help='Extract the hidden payload')
+    extract.add_argument('picture', type=str,
+                        help='picture"s path to extract from')
+    extract.add_argument('password', type=str,
+                        help='password to enc/dec')
+    extract.add_argument('--num-lsb', type=int, default=None,
+                        help='number of least significant bits used (detected if omitted)')
+    extract.add_argument('--cache-dir', type=str, default=None,
+                        help='directory for decoded carriers reused between runs')
+    output = extract.add_mutually_exclusive_group(required=True)
+    output.add_argument('--stdout', action='store_true',
+                        help='stream the decrypted payload to stdout')
+    output.add_argument('--output', type=str,
+                        help='file to write the decrypted payload to')
+
+    scan = subparsers.add_parser('scan', help='Find pictures carrying a payload')
+    scan.add_argument('directory', type=str,
+                        help='directory to scan recursively')
+    scan.add_argument('--index', type=str, default=None,
+                        help='index file to reuse and update between scans')
+    scan.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes')
+
+    calibrate = subparsers.add_parser('calibrate', help='Pick KDF parameters for this machine')
+    calibrate.add_argument('--kdf', type=str, default='pbkdf2', choices=('pbkdf2', 'scrypt'),
+                        help='key derivation function to calibrate')
+    calibrate.add_argument('--target-ms', type=int, default=1000,
+                        help='time a key derivation should take')
+
+    daemon = subparsers.add_parser('daemon', help='Serve embed/extract/probe requests on a Unix socket')
+    daemon.add_argument('socket', type=str,
+                        help='path of the Unix socket to listen on')
+    daemon.add_argument('--workers', type=int, default=None,
+                        help='number of worker threads')
+    daemon.add_argument('--cache-dir', type=str, default=None,
+                        help='directory for decoded carriers reused between runs')
+    daemon.add_argument('--encoder', type=parse_encoder, default=None,
+                        help='how pictures are written back: level:N, fastest, smallest:MS or background:N')
+
+    client = subparsers.add_parser('client', help='Send a request to a running daemon')
+    client.add_argument('socket', type=str,
+                        help='path of the daemon"s Unix socket')
+    client.add_argument('action', choices=('embed', 'extract', 'probe'),
+                        help='embed reads the payload from stdin, extract writes it to stdout')
+    client.add_argument('picture', type=str,
+                        help='picture"s path')
+    client.add_argument('password', type=str, nargs='?',
+                        help='password to enc/dec')
+    client.add_argument('--num-lsb', type=int, default=None,
+                        help='number of least significant bits used (detected if omitted)')
+    client.add_argument('--kdf', type=str, default=None,
+                        help='key derivation for embed, e.g. scrypt:n=32768,r=8,p=1')
+
+    # `main.py source mountpoint password picture` still mounts
+    if args and args[0] not in COMMANDS and not args[0].startswith('-'):
+        args = ['mount'] + list(args)
+
     return parser.parse_args(args)
 
-def main():
-    options = parse_args(sys.argv[1:])
+def carrier_cache_for(options):
+    if options.cache_dir is None:
+        return None
+    return CarrierCache(directory=options.cache_dir)
+
+def extract(options):
+    num_lsb = options.num_lsb or detect_num_lsb(options.picture)
+    steg = Steg(options.password, options.picture, None, num_lsb=num_lsb,
+                cache=carrier_cache_for(options))
+    if options.stdout:
+        out = sys.stdout.buffer
+    else:
+        out = open(options.output, 'wb')
+    try:
+        for chunk in steg.iter_decrypted_message(options.picture):
+            out.write(chunk)
+        out.flush()
+    finally:
+        if out is not sys.stdout.buffer:
+            out.close()
+
+def scan(options):
+    index = scan_directory(options.directory, options.index, options.workers)
+    for path, entry in sorted(index.items()):
+        if entry['candidates']:
+            num_lsbs = ','.join(str(num_lsb) for num_lsb, _, _ in entry['candidates'])
+            print(f'{path}\tnum_lsb={num_lsbs}')
+
+def calibrate_kdf(options):
+    kdf = calibrate(options.kdf, options.target_ms / 1000)
+    print(format_kdf(kdf))
+
+def serve(options):
+    server = Daemon(options.socket, options.workers, carrier_cache_for(options), options.encoder)
+    log.info('listening on %s', options.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def client(options):
+    daemon = DaemonClient(options.socket)
+    try:
+        if options.action == 'probe':
+            for num_lsb, size, version in daemon.probe(options.picture):
+                print(f'num_lsb={num_lsb}\tsize={size}\tversion={version}')
+        elif options.action == 'embed':
+            daemon.embed(options.picture, options.password, sys.stdin.buffer.read(),
+                         options.num_lsb, options.kdf)
+        else:
+            for chunk in daemon.extract(options.picture, options.password, options.num_lsb):
+                sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
+    finally:
+        daemon.close()
+
+def mount(options):
+    # FUSE is only needed for mounting, extraction works without it
+    import trio,pyfuse3
+    from filesystem import Operations
+
     # init_logging(options.debug)
-    operations = Operations(options.source,options.password,options.picture,options.source)
+    operations = Operations(options.source,options.password,options.picture,options.source,
+                            cache=carrier_cache_for(options),kdf=options.kdf,
+                            encoder=options.encoder)
 
     log.debug('Mounting...')
     fuse_options = set(pyfuse3.default_options)
@@ -78,6 +223,48 @@ def main():
 
         pyfuse3.close(unmount=True)
 
+def mount_many(options):
+    import trio,pyfuse3
+    from volumes import VolumeOperations, close_volumes, load_volumes, serve_volumes
+
+    # one cache, key cache and encoder for every volume
+    root, mountpoint, volumes = load_volumes(options.config, carrier_cache_for(options), options.encoder)
+    for volume in volumes:
+        volume.recover()
+    operations = VolumeOperations(root, volumes)
+
+    log.debug('Mounting %d volumes...', len(volumes))
+    fuse_options = set(pyfuse3.default_options)
+    fuse_options.add('fsname=operations')
+    pyfuse3.init(operations, mountpoint, fuse_options)
+
+    try:
+        trio.run(serve_volumes, operations, options.workers)
+    except Exception as e:
+        log.exception('main raised exception: %s', e)
+    finally:
+        log.debug('hiding data')
+        close_volumes(operations)
+        log.debug('Unmounting..')
+        pyfuse3.close(unmount=True)
+
+def main():
+    options = parse_args(sys.argv[1:])
+    if options.command == 'extract':
+        extract(options)
+    elif options.command == 'scan':
+        scan(options)
+    elif options.command == 'calibrate':
+        calibrate_kdf(options)
+    elif options.command == 'mount-many':
+        mount_many(options)
+    elif options.command == 'daemon':
+        serve(options)
+    elif options.command == 'client':
+        client(options)
+    else:
+        mount(options)
+
 if __name__ == '__main__':
     main()
 
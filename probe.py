@@ -0,0 +1,193 @@
+import os,sys,json,struct,zlib,logging
+
+import numpy as np
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+from bmp import open_bmp
+from frames import FrameCarrier, is_multiframe
+from crypto import HEADER, HEADER_LEN, HEAD_LEN, HASH
+from utils import roundup
+
+log = logging.getLogger(__name__)
+
+# number of carrier values read from the start of each image; enough for the
+# size tag and the crypto header with a single LSB
+PROBE_VALUES = 512
+MAX_LSB = 8
+IMAGE_EXTENSIONS = ('.png', '.bmp', '.tif', '.tiff')
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# PNG color types we can carry data in: truecolor and truecolor with alpha
+PNG_CHANNELS = {2: 3, 6: 4}
+
+Candidate = namedtuple('Candidate', ['num_lsb', 'size', 'version'])
+
+
+def probe_values(values, pixel_count):
+    """Checks the first carrier values of an image for a payload with every
+    num_lsb from 1 to MAX_LSB. Returns the list of plausible Candidates."""
+    values = np.asarray(values, dtype=np.uint8)
+    bits = np.unpackbits(values.reshape(-1, 1), axis=1)
+    candidates = []
+    for num_lsb in range(1, MAX_LSB + 1):
+        # same layout as Steg: size tag, then the encrypted data
+        max_bits = 3 * pixel_count * num_lsb
+        tag_size = roundup(max_bits.bit_length() / 8)
+        head_size = tag_size + HEADER_LEN
+        height = roundup(8 * head_size / num_lsb)
+        if height > len(values):
+            continue
+        head = np.packbits(bits[:height, 8 - num_lsb:]).tobytes()[:head_size]
+        if head[tag_size:] not in HEADER:
+            continue
+        version = HEADER.index(head[tag_size:])
+        size = int.from_bytes(head[:tag_size], byteorder=sys.byteorder)
+        min_size = HEAD_LEN[version] + HASH.digest_size
+        if min_size <= size <= max_bits // 8 - tag_size:
+            candidates.append(Candidate(num_lsb, size, version))
+    return candidates
+
+
+def read_head(path, count=PROBE_VALUES):
+    """Returns the pixel count of the image and its first count carrier
+    values, decoding as little of the file as possible."""
+    carrier = open_bmp(path)
+    if carrier is not None:
+        return carrier.size[0] * carrier.size[1], carrier[:count]
+    with open(path, 'rb') as f:
+        head = _png_head(f, count)
+    if head is not None:
+        return head
+    image = Image.open(path)
+    if is_multiframe(image):
+        carrier = FrameCarrier(image)
+        return carrier.pixel_count, carrier[:count]
+    values = np.asarray(image, dtype=np.uint8).reshape(-1)[:count]
+    return image.size[0] * image.size[1], values
+
+
+def _png_head(f, count):
+    """Inflates and unfilters only the leading bytes of the first rows of a
+    non-interlaced 8 bit PNG. Returns None for anything else."""
+    if f.read(len(PNG_SIGNATURE)) != PNG_SIGNATURE:
+        return None
+    length, kind = struct.unpack('>I4s', f.read(8))
+    if kind != b'IHDR' or length != 13:
+        return None
+    width, height, depth, color_type, _, _, interlace = struct.unpack('>IIBBBBB', f.read(13))
+    f.read(4)
+    if depth != 8 or interlace or color_type not in PNG_CHANNELS:
+        return None
+    bpp = PNG_CHANNELS[color_type]
+    stride = width * bpp
+    count = min(count, stride * height)
+    rows = roundup(count / stride)
+    need = (rows - 1) * (stride + 1) + 1 + count - (rows - 1) * stride
+
+    inflate = zlib.decompressobj()
+    raw = bytearray()
+    while len(raw) < need:
+        header = f.read(8)
+        if len(header) < 8:
+            return None
+        length, kind = struct.unpack('>I4s', header)
+        if kind == b'IEND' or kind == b'acTL':
+            # animated PNGs span every frame, let PIL count them
+            return None
+        data = f.read(length)
+        f.read(4)
+        if kind == b'IDAT':
+            raw += inflate.decompress(data, need - len(raw))
+
+    values = bytearray(count)
+    prior = bytearray(stride)
+    for row in range(rows):
+        start = row * (stride + 1)
+        filter_type = raw[start]
+        line = raw[start + 1:start + 1 + min(stride, count - row * stride)]
+        recon = bytearray(len(line))
+        for i, x in enumerate(line):
+            a = recon[i - bpp] if i >= bpp else 0
+            b = prior[i]
+            c = prior[i - bpp] if i >= bpp else 0
+            if filter_type == 1:
+                x += a
+            elif filter_type == 2:
+                x += b
+            elif filter_type == 3:
+                x += (a + b) // 2
+            elif filter_type == 4:
+                p = a + b - c
+                pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+                x += a if pa <= pb and pa <= pc else b if pb <= pc else c
+            recon[i] = x & 0xff
+        values[row * stride:row * stride + len(recon)] = recon
+        prior[:len(recon)] = recon
+    return width * height, np.frombuffer(bytes(values), dtype=np.uint8)
+
+
+def probe_image(path):
+    """Returns the Candidates for a payload hidden in the image at path."""
+    pixel_count, values = read_head(path)
+    return probe_values(values, pixel_count)
+
+
+def detect_num_lsb(path):
+    """Returns the num_lsb of the most likely payload in the image at path,
+    or None if it does not seem to carry one."""
+    candidates = probe_image(path)
+    if candidates:
+        return candidates[0].num_lsb
+    return None
+
+
+def _probe_entry(path):
+    try:
+        candidates = probe_image(path)
+    except Exception as e:
+        log.debug('unable to probe %s: %s', path, e)
+        candidates = []
+    return path, [list(c) for c in candidates]
+
+
+def scan_directory(root, index_path=None, workers=None):
+    """Probes every image under root in parallel and returns an index of
+    path -> {mtime_ns, size, candidates}. If index_path is given the index is
+    loaded from and saved to it, and unchanged images are not probed again."""
+    index = {}
+    if index_path is not None and os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+
+    stats = {}
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                path = os.path.join(dirpath, name)
+                stats[path] = os.stat(path)
+
+    todo = [
+        path for path, st in stats.items()
+        if path not in index
+        or index[path]['mtime_ns'] != st.st_mtime_ns
+        or index[path]['size'] != st.st_size
+    ]
+    log.info('probing %d of %d images', len(todo), len(stats))
+    with ProcessPoolExecutor(workers) as executor:
+        for path, candidates in executor.map(_probe_entry, todo, chunksize=64):
+            st = stats[path]
+            index[path] = {'mtime_ns': st.st_mtime_ns, 'size': st.st_size, 'candidates': candidates}
+
+    # forget images that were removed since the last scan
+    index = {
+        path: entry for path, entry in index.items()
+        if path in stats or not path.startswith(os.path.join(root, ''))
+    }
+
+    if index_path is not None:
+        tmp_path = index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, index_path)
+    return index
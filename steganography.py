@@ -1,19 +1,38 @@
 import sys,logging
 
+import numpy as np
 from PIL import Image
 from utils import (
-    lsb_deinterleave_list,
+    lsb_deinterleave_bytes,
+    lsb_interleave_bytes,
     lsb_interleave_list,
     roundup,
     str_to_bytes
 )
 from crypto import Crypto
+from encoder import Encoder
+from cache import CACHED_MODES, CachedCarrier, carrier_cache
+from bmp import BmpCarrier, open_bmp
+from frames import (
+    MULTIFRAME_FORMATS,
+    FrameCarrier,
+    embed_frames,
+    is_multiframe,
+    save_frames
+)
 
 log = logging.getLogger(__name__)
 
+# number of payload bytes recovered per step when streaming
+CHUNK_SIZE = 1 << 20
+
 class Steg():
-    def __init__(self,passwd,input_image_path,output_file_path,num_lsb=None,compression_level=None) -> None:
-        self.cry = Crypto(passwd)
+    def __init__(self,passwd,input_image_path,output_file_path,num_lsb=None,compression_level=None,
+                 cache=None,kdf=None,key_cache=None,encoder=None) -> None:
+        self.cry = Crypto(passwd, kdf, key_cache)
+        
+        # decoded carriers are shared between recovery and hiding
+        self.cache = cache or carrier_cache
         
         self.input_image_path = input_image_path
         
@@ -22,6 +41,9 @@ class Steg():
         self.num_lsb = num_lsb or 2
         self.compression_level = compression_level or 1
         
+        # how carriers are written back, see encoder.POLICIES
+        self.encoder = encoder or Encoder('level', self.compression_level)
+        
     def prepare_hide(self):
         """Prepare files for reading and writing for hiding data."""
         image = Image.open(self.input_image_path)
@@ -30,7 +52,7 @@ class Steg():
         
     def prepare_recover(self):
         """Prepare files for reading and writing for recovering data."""
-        steg_image = Image.open(self.input_image_path)
+        steg_image = self._open_image(self.input_image_path)
         # output_file = open('', "wb+")
         return steg_image
 
@@ -38,6 +60,8 @@ class Steg():
         """Returns the number of bits we're able to hide in the image using
         num_lsb least significant bits."""
         # 3 color channels per pixel, num_lsb bits per color channel.
+        if isinstance(image, FrameCarrier):
+            return int(3 * image.pixel_count * self.num_lsb)
         return int(3 * image.size[0] * image.size[1] * self.num_lsb)
 
     def bytes_in_max_file_size(self,image):
@@ -48,9 +72,19 @@ class Steg():
         """Hides the message in the input image and returns the modified
         image object.
         """
+        # uncompressed BMPs are rewritten in place, touching only the payload
+        carrier = open_bmp(self.input_image_path, 'r+')
+        if carrier is not None:
+            return self._hide_message_in_bmp(carrier, message)
+
+        image = self._open_image(self.input_image_path)
+        if isinstance(image, FrameCarrier):
+            return self._hide_message_in_frames(image.image, message)
+        if isinstance(image, CachedCarrier):
+            return self._hide_message_in_pixels(image, message)
+
         # start = time()
         # in some cases the image might already be opened
-        image = Image.open(self.input_image_path)
         # if isinstance(input_image, Image.Image):
         #     image = input_image
         # else:
@@ -59,6 +93,61 @@ class Steg():
         num_channels = len(image.getdata()[0])
         flattened_color_data = [v for t in image.getdata() for v in t]
 
+        data = self._build_payload(image, message)
+
+        # start = time()
+        flattened_color_data = lsb_interleave_list(flattened_color_data, data, self.num_lsb)
+        # log.debug(f"{message_size} bytes hidden".ljust(30) + f" in {time() - start:.2f}s")
+
+        # start = time()
+        image.putdata(list(zip(*[iter(flattened_color_data)] * num_channels)))
+        # log.debug("Image overwritten".ljust(30) + f" in {time() - start:.2f}s")
+        self.encoder.save(image, self.input_image_path)
+
+        return image
+
+    def _hide_message_in_bmp(self,carrier,message):
+        """Interleaves the message into the mapped BMP and flushes only the
+        pages it touched."""
+        data = self._build_payload(carrier, message)
+        bit_height = roundup(8 * len(data) / self.num_lsb)
+        interleaved = lsb_interleave_bytes(
+            carrier[:bit_height].tobytes(), data, self.num_lsb, truncate=True
+        )
+        carrier[:bit_height] = np.frombuffer(interleaved, dtype=np.uint8)
+        carrier.flush()
+        return carrier
+
+    def _hide_message_in_pixels(self,carrier,message):
+        """Interleaves the message into a copy of the decoded pixels, saves
+        them and caches them for the next recovery."""
+        data = self._build_payload(carrier, message)
+        bit_height = roundup(8 * len(data) / self.num_lsb)
+        pixels = np.array(carrier.pixels)
+        flat = pixels.reshape(-1)
+        flat[:bit_height] = np.frombuffer(
+            lsb_interleave_bytes(flat[:bit_height].tobytes(), data, self.num_lsb, truncate=True),
+            dtype=np.uint8,
+        )
+        image = Image.fromarray(pixels)
+        path = self.input_image_path
+        # a background recompression changes mtime and size, the cache key
+        self.encoder.save(image, path, on_replace=lambda: self.cache.put(path, pixels))
+        self.cache.put(path, pixels)
+        return image
+
+    def _hide_message_in_frames(self,image,message):
+        """Spreads the message over the frames of a multi-frame image, in
+        order, decoding and re-encoding one frame at a time."""
+        if image.format not in MULTIFRAME_FORMATS:
+            raise ValueError(f"{image.format} carriers with several frames are not supported")
+        carrier = FrameCarrier(image)
+        data = self._build_payload(carrier, message)
+        save_frames(image, embed_frames(image, data, self.num_lsb), self.input_image_path)
+        return carrier
+
+    def _build_payload(self,image,message):
+        """Encrypts the message and prefixes it with its size tag."""
         # We add the size of the input file to the beginning of the payload.
 
         data_encry_before = message
@@ -82,35 +171,71 @@ class Steg():
                 f"Only able to hide {max_bits // 8} bytes "
                 + f"in this image with {self.num_lsb} LSBs, but {len(data)} bytes were requested"
             )
+        return data
 
-        # start = time()
-        flattened_color_data = lsb_interleave_list(flattened_color_data, data, self.num_lsb)
-        # log.debug(f"{message_size} bytes hidden".ljust(30) + f" in {time() - start:.2f}s")
-
-        # start = time()
-        image.putdata(list(zip(*[iter(flattened_color_data)] * num_channels)))
-        # log.debug("Image overwritten".ljust(30) + f" in {time() - start:.2f}s")
-        image.save(self.input_image_path, compress_level=self.compression_level)
+    def recover_message_from_image(self,input_image):
+        """Returns the message from the steganographed image"""
+        return b''.join(self.iter_message_from_image(input_image))
 
-        return image
+    def iter_message_from_image(self,input_image,chunk_size=CHUNK_SIZE):
+        """Yields the message from the steganographed image in chunks of
+        about chunk_size bytes, without materializing the whole payload."""
+        steg_image = self._open_image(input_image)
+        color_data = self._color_data(steg_image)
+        file_size_tag_size, bytes_to_recover = self._recover_size(steg_image, color_data)
+        return self._iter_payload(color_data, file_size_tag_size, bytes_to_recover, chunk_size)
 
+    def iter_decrypted_message(self,input_image,chunk_size=CHUNK_SIZE):
+        """Yields the decrypted message from the steganographed image in
+        chunks. Authentication is checked before the first chunk is released."""
+        steg_image = self._open_image(input_image)
+        color_data = self._color_data(steg_image)
+        file_size_tag_size, bytes_to_recover = self._recover_size(steg_image, color_data)
+        return self.cry.decrypt_stream(
+            lambda: self._iter_payload(color_data, file_size_tag_size, bytes_to_recover, chunk_size),
+            bytes_to_recover,
+        )
 
-    def recover_message_from_image(self,input_image):
-        """Returns the message from the steganographed image"""
-        # start = time()
-        if isinstance(input_image, Image.Image):
-            steg_image = input_image
-        else:
-            steg_image = Image.open(input_image)
+    def _open_image(self,input_image):
+        # in some cases the image might already be opened
+        if isinstance(input_image, (BmpCarrier, FrameCarrier, CachedCarrier)):
+            return input_image
+        if not isinstance(input_image, Image.Image):
+            path = input_image
+            bmp = open_bmp(path)
+            if bmp is not None:
+                return bmp
+            pixels = self.cache.get(path)
+            if pixels is not None:
+                return CachedCarrier(path, pixels)
+            input_image = Image.open(path)
+            if not is_multiframe(input_image) and input_image.mode in CACHED_MODES:
+                pixels = np.asarray(input_image, dtype=np.uint8)
+                self.cache.put(path, pixels)
+                return CachedCarrier(path, pixels)
+        if is_multiframe(input_image):
+            return FrameCarrier(input_image)
+        return input_image
 
-        color_data = [v for t in steg_image.getdata() for v in t]
+    def _color_data(self,image):
+        """Returns the color values of the image as a flat uint8 array, in
+        the same order as a flattened image.getdata()."""
+        if isinstance(image, (BmpCarrier, FrameCarrier)):
+            # slices are read on demand
+            return image
+        if isinstance(image, CachedCarrier):
+            return image.pixels.reshape(-1)
+        return np.asarray(image, dtype=np.uint8).reshape(-1)
 
+    def _recover_size(self,steg_image,color_data):
+        """Returns the size of the file size tag and the number of payload
+        bytes it announces."""
         file_size_tag_size = self.bytes_in_max_file_size(steg_image)
         tag_bit_height = roundup(8 * file_size_tag_size / self.num_lsb)
 
         bytes_to_recover = int.from_bytes(
-            lsb_deinterleave_list(
-                color_data[:tag_bit_height], 8 * file_size_tag_size, self.num_lsb
+            lsb_deinterleave_bytes(
+                color_data[:tag_bit_height].tobytes(), 8 * file_size_tag_size, self.num_lsb
             ),
             byteorder=sys.byteorder,
         )
@@ -119,20 +244,27 @@ class Steg():
                 self.max_bits_to_hide(steg_image) // 8 - file_size_tag_size
         )
         if bytes_to_recover > maximum_bytes_in_image:
-            print(
-                "This image appears to be corrupted.\n"
-                + f"It claims to hold {bytes_to_recover} B, "
-                + f"but can only hold {maximum_bytes_in_image} B with {self.num_lsb} LSBs"
+            # nothing sensible can be streamed past the end of the carrier
+            raise ValueError(
+                f"The image carries no payload, or not with {self.num_lsb} LSBs: "
+                + f"it claims to hold {bytes_to_recover} B, "
+                + f"but can only hold {maximum_bytes_in_image} B"
             )
-            # raise
-        # log.debug("Files read".ljust(30) + f" in {time() - start:.2f}s")
-
-        # start = time()
-        data = lsb_deinterleave_list(
-            color_data, 8 * (bytes_to_recover + file_size_tag_size), self.num_lsb
-        )[file_size_tag_size:]
-        # log.debug(
-        #     f"{bytes_to_recover} bytes recovered".ljust(30) + f" in {time() - start:.2f}s"
-        # )
-        return data
+        return file_size_tag_size, bytes_to_recover
 
+    def _iter_payload(self,color_data,file_size_tag_size,bytes_to_recover,chunk_size):
+        """Deinterleaves the payload following the file size tag, one slice
+        of carrier values at a time."""
+        # a multiple of 8 carrier values always holds a whole number of bytes
+        step = roundup(8 * chunk_size / self.num_lsb, 8)
+        step_bytes = step * self.num_lsb // 8
+        total = file_size_tag_size + bytes_to_recover
+        for i, offset in enumerate(range(0, total, step_bytes)):
+            num_bytes = min(step_bytes, total - offset)
+            chunk = lsb_deinterleave_bytes(
+                color_data[i * step:(i + 1) * step].tobytes(), 8 * num_bytes, self.num_lsb
+            )
+            if offset < file_size_tag_size:
+                chunk = chunk[file_size_tag_size - offset:]
+            if chunk:
+                yield chunk
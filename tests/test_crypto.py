@@ -0,0 +1,70 @@
+import os,sys
+
+import pytest
+from Crypto.Cipher import AES
+from Crypto.Hash import HMAC, SHA256
+from Crypto.Protocol.KDF import PBKDF2
+from Crypto.Util import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from crypto import (
+    Crypto, DecryptionException, Kdf, EXPANSION_COUNT, HEADER, HEADER_LEN, KDF_PARAMS, SALT_LEN
+)
+
+
+def legacy_encrypt(password, data, version):
+    # the payload layout written before the KDF header existed, keys derived
+    # with PyCryptodome's PBKDF2 as they were back then
+    salt = os.urandom(SALT_LEN[version] // 8)
+    keys = PBKDF2(password, salt, dkLen=64, count=EXPANSION_COUNT[version], hmac_hash_module=SHA256)
+    hmac_key, cipher_key = keys[:32], keys[32:]
+    counter = Counter.new(64, prefix=salt[:8])
+    encrypted = AES.new(cipher_key, AES.MODE_CTR, counter=counter).encrypt(data)
+    hmac = HMAC.new(hmac_key, HEADER[version] + salt + encrypted, SHA256).digest()
+    return HEADER[version] + salt + encrypted + hmac
+
+
+def chunked(data, size=1000):
+    return lambda: (data[i:i + size] for i in range(0, len(data), size))
+
+
+@pytest.mark.parametrize('version', [0, 1, 2])
+def test_legacy_payloads_decrypt(version):
+    message = os.urandom(5000)
+    encrypted = legacy_encrypt(b'password', message, version)
+
+    assert Crypto('password').decrypt(encrypted) == message
+    stream = Crypto('password').decrypt_stream(chunked(encrypted), len(encrypted))
+    assert b''.join(stream) == message
+
+
+@pytest.mark.parametrize('kdf', [Kdf('pbkdf2', 1000, 0, 0), Kdf('scrypt', 1 << 10, 8, 1)])
+def test_round_trip(kdf):
+    message = os.urandom(5000)
+    encrypted = Crypto('password', kdf=kdf).encrypt(message)
+
+    assert encrypted[:HEADER_LEN] == HEADER[3]
+    # the parameters are read back from the header, not from the instance
+    assert Crypto('password').decrypt(encrypted) == message
+    stream = Crypto('password').decrypt_stream(chunked(encrypted), len(encrypted))
+    assert b''.join(stream) == message
+    with pytest.raises(DecryptionException):
+        Crypto('wrong').decrypt(encrypted)
+
+
+@pytest.mark.parametrize('params', [
+    (9, 1000, 0, 0),            # unknown KDF
+    (1, 0, 0, 0),               # no PBKDF2 iterations
+    (2, 1000, 8, 1),            # scrypt n not a power of two
+    (2, 1 << 30, 1 << 15, 1),   # scrypt memory out of bounds
+    (1, 1001, 0, 0),            # valid, but not what the MAC covers
+])
+def test_tampered_kdf_header_is_rejected(params):
+    encrypted = Crypto('password', kdf=Kdf('pbkdf2', 1000, 0, 0)).encrypt(b'message')
+    tampered = encrypted[:HEADER_LEN] + KDF_PARAMS.pack(*params) + encrypted[HEADER_LEN + KDF_PARAMS.size:]
+
+    with pytest.raises(DecryptionException):
+        Crypto('password').decrypt(tampered)
+    with pytest.raises(DecryptionException):
+        b''.join(Crypto('password').decrypt_stream(chunked(tampered), len(tampered)))
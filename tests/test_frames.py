@@ -0,0 +1,43 @@
+import os,sys
+
+import numpy as np
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from steganography import Steg
+
+
+def save_pages(path, mode, count=3, size=(40, 30)):
+    rng = np.random.default_rng(0)
+    bands = len(Image.new(mode, (1, 1)).getbands())
+    pages = [
+        Image.fromarray(rng.integers(0, 256, (size[1], size[0], bands), dtype=np.uint8).squeeze(), mode)
+        for _ in range(count)
+    ]
+    pages[0].save(path, save_all=True, append_images=pages[1:], compression='raw')
+
+
+def test_rgba_pages_round_trip(tmp_path):
+    path = str(tmp_path / 'cover.tiff')
+    save_pages(path, 'RGBA')
+    # spans more than one page with 2 LSBs
+    message = os.urandom(1500)
+    Steg('password', path, None, num_lsb=2).hide_message_in_image(message)
+
+    assert Image.open(path).n_frames == 3
+    assert b''.join(Steg('password', path, None, num_lsb=2).iter_decrypted_message(path)) == message
+
+
+def test_grayscale_pages_are_refused(tmp_path):
+    path = str(tmp_path / 'cover.tiff')
+    save_pages(path, 'L')
+    with open(path, 'rb') as f:
+        before = f.read()
+
+    with pytest.raises(ValueError):
+        Steg('password', path, None, num_lsb=2).hide_message_in_image(os.urandom(1500))
+
+    with open(path, 'rb') as f:
+        assert f.read() == before
@@ -0,0 +1,94 @@
+import os,sys,struct
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from volume import (
+    VOLUME_MAGIC, gather_files, gather_links, pack_files, is_volume, unpack_files, unpack_links,
+    write_files, write_links
+)
+
+
+def make_tree(root):
+    shared = os.urandom(200 * 1024)
+    files = {
+        'top.txt': b'hello',
+        'empty': b'',
+        'sub/copy.bin': shared,
+        'sub/deeper/same.bin': shared,
+    }
+    for name, data in files.items():
+        path = os.path.join(root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+    os.symlink('top.txt', os.path.join(root, 'link'))
+    os.symlink('../top.txt', os.path.join(root, 'sub', 'up'))
+    os.symlink('deeper', os.path.join(root, 'sub', 'dirlink'))
+    return files
+
+
+def test_gather_files_reads_regular_files_only(tmp_path):
+    files = make_tree(str(tmp_path))
+
+    gathered = gather_files(str(tmp_path), workers=2)
+
+    assert [name for name, _ in gathered] == sorted(files)
+    assert {name: bytes(data) for name, data in gathered} == files
+    assert gather_links(str(tmp_path)) == [
+        ('link', 'top.txt'), ('sub/dirlink', 'deeper'), ('sub/up', '../top.txt')
+    ]
+    with pytest.raises(ValueError):
+        gather_files(str(tmp_path), max_bytes=1000)
+
+
+def test_round_trip(tmp_path):
+    source, target = str(tmp_path / 'source'), str(tmp_path / 'target')
+    os.makedirs(source)
+    files = make_tree(source)
+
+    payload = pack_files(gather_files(source), gather_links(source))
+    assert is_volume(payload)
+    assert {name: bytes(data) for name, data in unpack_files(payload)} == files
+
+    os.makedirs(target)
+    assert write_files(target, unpack_files(payload)) == len(files)
+    assert write_links(target, unpack_links(payload)) == 3
+    assert {name: bytes(data) for name, data in gather_files(target)} == files
+    assert gather_links(target) == gather_links(source)
+    assert os.path.isfile(os.path.join(target, 'sub', 'dirlink', 'same.bin'))
+
+
+def test_identical_chunks_are_stored_once():
+    data = os.urandom(300 * 1024)
+    once = pack_files([('a', data)])
+    twice = pack_files([('a', data), ('b', data)])
+
+    # only a name and the chunk numbers more
+    assert len(twice) - len(once) < 1024
+    assert dict(unpack_files(twice)) == {'a': data, 'b': data}
+
+
+def test_empty_volume():
+    payload = pack_files([])
+
+    assert payload == VOLUME_MAGIC + struct.pack('<III', 0, 0, 0)
+    assert list(unpack_files(payload)) == []
+    assert unpack_links(payload) == []
+
+
+def test_symlink_table_is_required():
+    payload = pack_files([('a', b'data')])
+
+    with pytest.raises(struct.error):
+        unpack_links(payload[:-4])
+
+
+def test_names_outside_root_are_skipped(tmp_path):
+    root = str(tmp_path / 'root')
+    os.makedirs(root)
+
+    assert write_files(root, [('../escape', b'x'), ('/abs', b'x')]) == 0
+    assert write_links(root, [('../escape', 'x')]) == 0
+    assert os.listdir(str(tmp_path)) == ['root']
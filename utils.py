@@ -90,3 +90,17 @@ def lsb_deinterleave_list(carrier, num_bits, num_lsb):
     carrier_bytes = np.array(carrier[:plen], dtype=np.uint8).tobytes()
     deinterleaved = lsb_deinterleave_bytes(carrier_bytes, num_bits, num_lsb)
     return deinterleaved
+
+def lsb_values(payload, num_lsb):
+    """Splits payload into the num_lsb bit values written into each carrier
+    value, in the same order as lsb_interleave_bytes.
+    :param payload: payload bytes
+    :param num_lsb: number of least significant bits to use
+    :return: uint8 array with one value per carrier value
+    """
+
+    bits = np.unpackbits(np.frombuffer(payload, dtype=np.uint8))
+    bit_height = roundup(len(bits) / num_lsb)
+    padded = np.zeros(bit_height * num_lsb, dtype=np.uint8)
+    padded[:len(bits)] = bits
+    return np.packbits(padded.reshape(bit_height, num_lsb), axis=1)[:, 0] >> (8 - num_lsb)
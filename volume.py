@@ -0,0 +1,265 @@
+import os,shutil,struct,hashlib
+
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# Payload layout, all integers little endian:
+#   VOLUME_MAGIC
+#   u32 chunk count, u32 length of every chunk, chunk data
+#   u32 file count, per file: u16 name length, utf-8 name, u32 chunk count, u32 chunk numbers
+#   u32 symlink count, per link: u16 name length, utf-8 name, u16 target length, target
+# Legacy payloads start with a file name, so they never start with a NUL.
+VOLUME_MAGIC = b'\x00stgvol\x01'
+
+# content-defined chunking, see FastCDC (Xia et al., 2016)
+MIN_CHUNK = 2 * 1024
+MAX_CHUNK = 64 * 1024
+# 13 bits set -> 8 KiB average chunks; the high bits depend on the last 32 bytes
+CUT_MASK = np.uint32(((1 << 13) - 1) << 19)
+WINDOW = 32
+# bytes hashed per numpy pass, bounds the temporary hash array
+BLOCK = 16 * 1024 * 1024
+GEAR = np.frombuffer(hashlib.shake_128(b'steganografia gear').digest(256 * 4), dtype='<u4')
+
+
+def _gear_hashes(data):
+    """Returns the gear rolling hash ending at every byte of data."""
+    values = GEAR[np.frombuffer(data, dtype=np.uint8)]
+    hashes = values.copy()
+    for k in range(1, min(WINDOW, len(values))):
+        hashes[k:] += values[:-k] << np.uint32(k)
+    return hashes
+
+
+def chunk_boundaries(data):
+    """Returns the end offsets of the content-defined chunks of data."""
+    size = len(data)
+    candidates = []
+    for start in range(0, size, BLOCK):
+        # overlap the previous block so every hash sees a full window
+        lead = min(start, WINDOW - 1)
+        hashes = _gear_hashes(data[start - lead:start + BLOCK])[lead:]
+        candidates.extend((np.flatnonzero((hashes & CUT_MASK) == 0) + start + 1).tolist())
+
+    cuts = []
+    last = 0
+    for cut in candidates:
+        while cut - last > MAX_CHUNK:
+            last += MAX_CHUNK
+            cuts.append(last)
+        if cut - last >= MIN_CHUNK:
+            cuts.append(cut)
+            last = cut
+    while size - last > MAX_CHUNK:
+        last += MAX_CHUNK
+        cuts.append(last)
+    if last < size:
+        cuts.append(size)
+    return cuts
+
+
+def gather_files(root, workers=None, max_bytes=None):
+    """Reads every regular file under root into one preallocated buffer,
+    using a thread pool so many small files overlap their disk latency.
+    Returns a list of (path relative to root, memoryview) pairs. Raises
+    ValueError before allocating if the files add up to more than max_bytes."""
+    entries = []
+    directories = [root]
+    while directories:
+        with os.scandir(directories.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    entries.append((entry.path, entry.stat(follow_symlinks=False).st_size))
+    entries.sort()
+
+    offsets = np.cumsum([0] + [size for _, size in entries]).tolist()
+    if max_bytes is not None and offsets[-1] > max_bytes:
+        raise ValueError(f'{root} holds {offsets[-1]} bytes, over its budget of {max_bytes} bytes')
+    buffer = memoryview(bytearray(offsets[-1]))
+
+    def read(index):
+        path, size = entries[index]
+        target = buffer[offsets[index]:offsets[index] + size]
+        with open(path, 'rb', buffering=0) as f:
+            while target:
+                n = f.readinto(target)
+                if not n:
+                    # the file shrank since it was listed
+                    break
+                target = target[n:]
+        return size - len(target)
+
+    with ThreadPoolExecutor(workers) as executor:
+        lengths = list(executor.map(read, range(len(entries))))
+
+    return [
+        (os.path.relpath(path, root).replace(os.sep, '/'), buffer[offset:offset + length])
+        for (path, _), offset, length in zip(entries, offsets, lengths)
+    ]
+
+
+def gather_links(root):
+    """Returns the (path relative to root, target) pairs of every symlink
+    under root. Links are recorded, not followed."""
+    links = []
+    directories = [root]
+    while directories:
+        with os.scandir(directories.pop()) as it:
+            for entry in it:
+                if entry.is_symlink():
+                    links.append((os.path.relpath(entry.path, root).replace(os.sep, '/'),
+                                  os.readlink(entry.path)))
+                elif entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+    return sorted(links)
+
+
+def _safe_name(name):
+    return not os.path.isabs(name) and '..' not in name.split('/')
+
+
+def write_files(root, files, overwrite=True):
+    """Writes (name, data) pairs under root, skipping names that would land
+    outside of it and, unless overwrite is set, names that already exist.
+    Returns the number of files written."""
+    count = 0
+    for name, content in files:
+        if not _safe_name(name):
+            continue
+        path = os.path.join(root, name)
+        if not overwrite and os.path.lexists(path):
+            continue
+        if not os.path.isdir(path):
+            print('creating',path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb+") as f:
+                f.write(content)
+            count += 1
+    return count
+
+
+def write_links(root, links, overwrite=True):
+    """Creates (name, target) symlinks under root, with the same rules as
+    write_files. Returns the number of links created."""
+    count = 0
+    for name, target in links:
+        if not _safe_name(name):
+            continue
+        path = os.path.join(root, name)
+        if os.path.lexists(path):
+            if not overwrite or (os.path.isdir(path) and not os.path.islink(path)):
+                continue
+            os.remove(path)
+        print('linking',path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.symlink(target, path)
+        count += 1
+    return count
+
+
+def clear_files(root):
+    """Removes everything under root, leaving root itself."""
+    for name in os.listdir(root):
+        print('removing',name)
+        path = os.path.join(root, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+
+def pack_files(files, links=()):
+    """Packs (name, data) pairs and (name, target) symlinks into a volume
+    payload, storing every distinct chunk once. Returns a bytearray."""
+    chunks = []
+    chunk_index = {}
+    entries = []
+    for name, data in files:
+        view = memoryview(data).cast('B')
+        refs = []
+        start = 0
+        for end in chunk_boundaries(view):
+            piece = view[start:end]
+            digest = hashlib.sha256(piece).digest()
+            if digest not in chunk_index:
+                chunk_index[digest] = len(chunks)
+                chunks.append(piece)
+            refs.append(chunk_index[digest])
+            start = end
+        entries.append((name, refs))
+
+    payload = bytearray(VOLUME_MAGIC)
+    payload += struct.pack('<I', len(chunks))
+    payload += np.array([len(c) for c in chunks], dtype='<u4').tobytes()
+    for chunk in chunks:
+        payload += chunk
+    payload += struct.pack('<I', len(entries))
+    for name, refs in entries:
+        encoded = name.encode('utf8')
+        payload += struct.pack('<H', len(encoded)) + encoded
+        payload += struct.pack('<I', len(refs)) + np.array(refs, dtype='<u4').tobytes()
+    payload += struct.pack('<I', len(links))
+    for name, target in links:
+        encoded = name.encode('utf8')
+        payload += struct.pack('<H', len(encoded)) + encoded
+        encoded = os.fsencode(target)
+        payload += struct.pack('<H', len(encoded)) + encoded
+    return payload
+
+
+def is_volume(data):
+    return bytes(data[:len(VOLUME_MAGIC)]) == VOLUME_MAGIC
+
+
+def _file_table(view):
+    """Returns the chunk offsets, the (name, chunk numbers) of every file and
+    the position right after the file table."""
+    pos = len(VOLUME_MAGIC)
+    (num_chunks,) = struct.unpack_from('<I', view, pos)
+    pos += 4
+    lengths = np.frombuffer(view, dtype='<u4', count=num_chunks, offset=pos)
+    pos += 4 * num_chunks
+    offsets = (pos + np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))).tolist()
+    pos = offsets[-1]
+    (num_files,) = struct.unpack_from('<I', view, pos)
+    pos += 4
+    entries = []
+    for _ in range(num_files):
+        (name_len,) = struct.unpack_from('<H', view, pos)
+        pos += 2
+        name = bytes(view[pos:pos + name_len]).decode('utf8')
+        pos += name_len
+        (num_refs,) = struct.unpack_from('<I', view, pos)
+        pos += 4
+        entries.append((name, np.frombuffer(view, dtype='<u4', count=num_refs, offset=pos).tolist()))
+        pos += 4 * num_refs
+    return offsets, entries, pos
+
+
+def unpack_files(data):
+    """Yields the (name, bytes) pairs of a volume payload, rebuilding each
+    file from the chunk table only when it is reached."""
+    view = memoryview(data)
+    offsets, entries, _ = _file_table(view)
+    for name, refs in entries:
+        yield name, b''.join(view[offsets[r]:offsets[r + 1]] for r in refs)
+
+
+def unpack_links(data):
+    """Returns the (name, target) symlinks of a volume payload."""
+    view = memoryview(data)
+    _, _, pos = _file_table(view)
+    (num_links,) = struct.unpack_from('<I', view, pos)
+    pos += 4
+    links = []
+    for _ in range(num_links):
+        texts = []
+        for _ in range(2):
+            (length,) = struct.unpack_from('<H', view, pos)
+            pos += 2
+            texts.append(bytes(view[pos:pos + length]))
+            pos += length
+        links.append((texts[0].decode('utf8'), os.fsdecode(texts[1])))
+    return links
@@ -0,0 +1,178 @@
+import os,json,logging
+
+import trio
+
+from filesystem import Operations, WRITE_BUFFER_SIZE, WRITE_BUFFER_LIMIT
+from steganography import Steg
+from probe import detect_num_lsb
+from crypto import KeyCache, parse_kdf
+from volume import (
+    gather_files, gather_links, pack_files, is_volume, unpack_files, unpack_links,
+    write_files, write_links, clear_files
+)
+
+log = logging.getLogger(__name__)
+
+# seconds between two checkpoints of a volume
+CHECKPOINT_INTERVAL = 60
+# num_lsb for pictures that do not carry a volume yet
+DEFAULT_NUM_LSB = 2
+
+# Config file layout:
+# {
+#   "root": directory holding one subdirectory per volume,
+#   "mountpoint": where root is mounted,
+#   "volumes": [
+#     {"name", "picture", "password", "num_lsb"?, "kdf"?, "max_bytes"?, "checkpoint"?}
+#   ]
+# }
+
+
+class Volume(Steg):
+    """A hidden volume kept in `picture` and unpacked in `root/name`. Its
+    files are packed back into the picture on every checkpoint."""
+
+    def __init__(self, name, root, picture, password, num_lsb=None, kdf=None,
+                 max_bytes=None, checkpoint=CHECKPOINT_INTERVAL,
+                 cache=None, key_cache=None, encoder=None) -> None:
+        self.name = name
+        self.max_bytes = max_bytes
+        self.checkpoint_interval = checkpoint
+        source = os.path.join(root, name)
+        os.makedirs(source, exist_ok=True)
+        super().__init__(password, picture, source,
+                         num_lsb=num_lsb or detect_num_lsb(picture) or DEFAULT_NUM_LSB,
+                         cache=cache, kdf=kdf, key_cache=key_cache, encoder=encoder)
+        # state of the tree when it last matched the picture
+        self._signature = None
+
+    def _tree_signature(self):
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(self.output_file_path):
+            # links to directories are listed but not walked into
+            for name in filenames + [d for d in dirnames if os.path.islink(os.path.join(dirpath, d))]:
+                st = os.lstat(os.path.join(dirpath, name))
+                entries.append((os.path.join(dirpath, name), st.st_size, st.st_mtime_ns))
+        return sorted(entries)
+
+    def recover(self):
+        """Unpacks the volume into its directory. Returns the number of files
+        written, 0 if the picture carries no volume yet."""
+        # files left behind by a run that could not hide them are not in the
+        # picture, so the next checkpoint must not skip them
+        leftover = bool(self._tree_signature())
+        if detect_num_lsb(self.input_image_path) is None:
+            log.info('%s: %s carries no volume yet', self.name, self.input_image_path)
+            count = 0
+        else:
+            data = self.cry.decrypt(self.recover_message_from_image(self.input_image_path))
+            if not is_volume(data):
+                raise ValueError(f'{self.input_image_path} holds a legacy payload, mount it on its own')
+            # leftover files are newer than the picture's copies, keep them
+            count = write_files(self.output_file_path, unpack_files(data), overwrite=not leftover)
+            count += write_links(self.output_file_path, unpack_links(data), overwrite=not leftover)
+            log.info('%s: recovered %d files', self.name, count)
+        if leftover:
+            log.warning('%s: %s was not empty, its files will be hidden again',
+                        self.name, self.output_file_path)
+        else:
+            self._signature = self._tree_signature()
+        return count
+
+    def checkpoint(self):
+        """Hides the volume's files in its picture if they changed since the
+        last checkpoint. Returns True if the picture was rewritten."""
+        signature = self._tree_signature()
+        if signature == self._signature:
+            return False
+        files = gather_files(self.output_file_path, max_bytes=self.max_bytes)
+        self.hide_message_in_image(pack_files(files, gather_links(self.output_file_path)))
+        self._signature = signature
+        log.info('%s: checkpointed %d files', self.name, len(files))
+        return True
+
+
+class VolumeOperations(Operations):
+    """Mirrors a root directory whose subdirectories are the hidden volumes,
+    so one FUSE session serves all of them."""
+
+    def __init__(self, root, volumes, write_buffer_size=WRITE_BUFFER_SIZE,
+                 write_buffer_limit=WRITE_BUFFER_LIMIT) -> None:
+        # hiding and recovering is left to the volumes
+        self.volumes = volumes
+        self._init_passthrough(root, write_buffer_size, write_buffer_limit)
+
+    def flush_volume(self, volume):
+        """Writes out the pending writes to files of volume."""
+        prefix = os.path.join(volume.output_file_path, '')
+        for fd in list(self._write_buffers):
+            path = self._inode_path_map.get(self._fd_inode_map.get(fd))
+            paths = path if isinstance(path, set) else {path}
+            if any(p and p.startswith(prefix) for p in paths):
+                self._flush_fd(fd)
+
+
+async def checkpoint_loop(volume, operations, limiter):
+    """Checkpoints volume every volume.checkpoint_interval seconds, on a
+    worker thread taken from the shared limiter."""
+    while True:
+        await trio.sleep(volume.checkpoint_interval)
+        operations.flush_volume(volume)
+        try:
+            await trio.to_thread.run_sync(volume.checkpoint, limiter=limiter)
+        except Exception as e:
+            # e.g. over budget or too big for the picture, keep serving
+            log.error('%s: checkpoint failed: %s', volume.name, e)
+
+
+async def serve_volumes(operations, workers=None):
+    """Runs the FUSE main loop and the checkpoints of every volume until
+    the file system is unmounted."""
+    import pyfuse3
+    limiter = trio.CapacityLimiter(workers or len(operations.volumes) or 1)
+    async with trio.open_nursery() as nursery:
+        for volume in operations.volumes:
+            nursery.start_soon(checkpoint_loop, volume, operations, limiter)
+        await pyfuse3.main()
+        nursery.cancel_scope.cancel()
+
+
+def close_volumes(operations):
+    """Hides every volume one last time and clears its directory. Volumes
+    that fail keep their files so nothing is lost."""
+    operations._flush_all()
+    for volume in operations.volumes:
+        try:
+            volume.checkpoint()
+        except Exception as e:
+            log.error('%s: final checkpoint failed, leaving %s in place: %s',
+                      volume.name, volume.output_file_path, e)
+            continue
+        clear_files(volume.output_file_path)
+
+
+def load_volumes(path, cache=None, encoder=None):
+    """Reads a config file. Returns (root, mountpoint, volumes); the volumes
+    share the decoded carrier cache, the derived key cache and the encoder."""
+    with open(path) as f:
+        config = json.load(f)
+    root = config['root']
+    key_cache = KeyCache()
+    volumes = []
+    for entry in config['volumes']:
+        name = entry['name']
+        if not name or name in ('.', '..') or '/' in name:
+            raise ValueError(f'Invalid volume name {name!r}.')
+        kdf = parse_kdf(entry['kdf']) if entry.get('kdf') else None
+        volumes.append(Volume(
+            name, root, entry['picture'], entry['password'],
+            num_lsb=entry.get('num_lsb'), kdf=kdf, max_bytes=entry.get('max_bytes'),
+            checkpoint=entry.get('checkpoint', CHECKPOINT_INTERVAL),
+            cache=cache, key_cache=key_cache, encoder=encoder,
+        ))
+
+    names = [volume.name for volume in volumes]
+    pictures = [os.path.realpath(volume.input_image_path) for volume in volumes]
+    if len(set(names)) != len(names) or len(set(pictures)) != len(pictures):
+        raise ValueError('Every volume needs its own name and picture.')
+    return root, config['mountpoint'], volumes